@@ -1,19 +1,29 @@
+import os
 import sqlite3
 import threading
+import time
+import traceback
 from datetime import datetime
-from multiprocessing import Process
+from multiprocessing import Process, Queue
 
-from flask import Flask, render_template, request
-import webview
+from flask import Flask, jsonify, render_template, request
 
+import config
+import en_risk
+import en_session
+import telemetry
 from en_bluetooth import send, receive
 from en_crypto import ENKeys
-from en_diagnosis import refresh_diagnosis
+from en_diagnosis import RefreshError, refresh_diagnosis
 from en_positive import positive_otp
 
 DATABASE = 'db.sqlite'
 app = Flask(__name__, static_folder='./static', template_folder='./templates')
 
+telemetry_queue = Queue()
+refresh_lock = threading.Lock()
+window = None
+
 global sendThread
 global receiveThread
 global updateThread
@@ -21,20 +31,24 @@ global updateThread
 
 @app.route('/')
 def index(uploaded=None):
-    refresh_diagnosis()
+    if not en_session.connected():
+        # Without a session the server cannot tell us about new keys, so check for them whenever the page loads
+        threading.Thread(target=refresh_and_reload, daemon=True).start()
     con = sqlite3.connect(DATABASE)
     exposures = []
-    with con:
+    with con, telemetry.timed("sqlite_exposures"):
         cur = con.cursor()
-        cur.execute("SELECT id, en_interval_number FROM Diagnosis_keys ORDER BY en_interval_number DESC")
+        # Matches recorded before risk scoring was added are scored once, here
+        en_risk.score_missing(cur)
+        cur.execute("SELECT Diagnosis_Keys.en_interval_number, sightings, weighted_minutes FROM Diagnosis_Keys "
+                    "JOIN Exposure_Risk ON Exposure_Risk.diagnosis_key_id = Diagnosis_Keys.id "
+                    "ORDER BY Diagnosis_Keys.en_interval_number DESC")
 
         results = cur.fetchall()
-        for result in results:
-            timestamp = ENKeys.get_enin_timestamp(result[1])
+        for enin, num_exposures, minutes in results:
+            timestamp = ENKeys.get_enin_timestamp(enin)
             date = datetime.fromtimestamp(timestamp).strftime('%d/%m/%Y')
 
-            cur.execute("SELECT COUNT(*) FROM Close_Contacts WHERE diagnosis_key_id = ?", (result[0],))
-            num_exposures = cur.fetchone()[0]
             period = ""
             if num_exposures == 1:
                 period = "< 15 minutes"
@@ -43,7 +57,8 @@ def index(uploaded=None):
             else:
                 period = f"{num_exposures // 4} hour{'s' if num_exposures >= 8 else ''}"
 
-            exposures.append((date, period))
+            # Sightings without a measured signal strength have no weighted minutes
+            exposures.append((date, period, None if minutes is None else round(minutes)))
         cur.close()
     con.close()
 
@@ -57,6 +72,41 @@ def positive():
     return index(uploaded=result)
 
 
+@app.route('/diagnostics')
+def diagnostics():
+    """
+    Reports recent timings of the app's hot paths and counts of the work done, including the bluetooth receive
+    process
+    """
+    telemetry.collect(telemetry_queue)
+    return jsonify(telemetry.snapshot())
+
+
+def refresh_and_reload(shards=None):
+    """
+    Refreshes the diagnosis keys in the background, so pages render straight from the local database without waiting
+    for the server. Reloads the window if new exposures were found.
+
+    :param shards: the ``(region, day)`` shards the server announced new keys for, see ``refresh_diagnosis``
+    :return: True if the keys were downloaded and checked, see ``en_session.Session``
+    """
+    # Announced keys must always be fetched, other refreshes are skipped if one is already running
+    if not refresh_lock.acquire(blocking=shards is not None):
+        return False
+
+    try:
+        if refresh_diagnosis(shards) and window is not None:
+            window.load_url("/")
+        return True
+    except RefreshError as err:
+        print(f"< {err}")
+    except Exception:
+        print(traceback.format_exc())
+    finally:
+        refresh_lock.release()
+    return False
+
+
 class LoopThread(threading.Timer):
     """
     A thread that repeatedly executes on a set period
@@ -74,19 +124,35 @@ def backend():
     global receiveThread
     global updateThread
     sendThread = LoopThread(900, send)
-    receiveThread = Process(target=receive)
+    receiveThread = Process(target=receive_process, args=(telemetry_queue,))
     updateThread = LoopThread(7200, update)
 
     sendThread.start()
     receiveThread.start()
     updateThread.start()
 
+    # Removing expired keys and exposures is not needed to show the window
+    threading.Thread(target=ENKeys.remove_old_db, daemon=True).start()
+
+    # Catch up on new keys whenever the session connects, then wait for the server to announce more
+    home_region, travel_regions = config.region_info()
+    en_session.start([home_region] + travel_regions, on_connect=refresh_and_reload, on_new_batch=refresh_and_reload)
+
+
+def receive_process(queue):
+    """
+    Entry point of the bluetooth receive process, forwards its telemetry to the app process
+    """
+    telemetry.forward_to(queue)
+    receive()
+
 
 def update():
     """
     Reloads the window
     """
-    window.load_url("/index")
+    telemetry.collect(telemetry_queue)
+    window.load_url("/")
 
 
 def on_close():
@@ -98,9 +164,22 @@ def on_close():
     updateThread.cancel()
 
 
+def on_first_load():
+    """
+    Used by bench_startup.py to measure time-to-first-window. Reports when the first page has loaded and quits.
+    """
+    print(f"first window {time.time()}", flush=True)
+    window.destroy()
+
+
 if __name__ == '__main__':
     #app.run()
     backend()
+
+    import webview
+
     window = webview.create_window('Coronomo', app, width=400)
     window.closing += on_close
+    if os.environ.get("CORONOMO_STARTUP_BENCHMARK"):
+        window.loaded += on_first_load
     webview.start()
@@ -0,0 +1,141 @@
+"""
+Micro-benchmark of the crypto backends.
+
+Before timing anything, every installed backend is checked against known answers: the Exposure Notification reference
+test vector (RPIK, AEMK, RPI and AEM of one key and interval), RFC 5869 test case 3 for HKDF, FIPS-197 for AES and
+NIST SP 800-38A for AES-CTR. Every backend must then derive the same RPIs and AEMs as the others for a set of random
+keys. The benchmark exits with an error if any check fails.
+
+Usage: ``python bench_crypto.py [--runs 5] [--keys 200]``
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import crypto_backend
+import en_crypto
+from en_crypto import ENKeys, TEK_ROLLING_PERIOD
+
+# Exposure Notification reference test vector
+EN_TEK = bytes.fromhex("75c734c6dd1a782de7a965da5eb93125")
+EN_ENIN = 2642976
+EN_METADATA = bytes.fromhex("40080000")
+EN_RPIK = bytes.fromhex("185ad91db69ec7dd048960f1f3ba6175")
+EN_AEMK = bytes.fromhex("d57c46af7a1d83965b9bed8bd152936a")
+EN_RPI = bytes.fromhex("8be6cd371c5c891604bfbe49df845096")
+EN_AEM = bytes.fromhex("72033874")
+
+# RFC 5869 test case 3, SHA-256 without salt or info
+HKDF_IKM = b"\x0b" * 22
+HKDF_OKM = bytes.fromhex("8da4e775a563c18f715f802a063c5a31b8a11f5c5ee1879ec3454e5f3c738d2d9d201395faa4b61a96c8")
+
+# FIPS-197 appendix C.1
+AES_KEY = bytes.fromhex("000102030405060708090a0b0c0d0e0f")
+AES_PLAINTEXT = bytes.fromhex("00112233445566778899aabbccddeeff")
+AES_CIPHERTEXT = bytes.fromhex("69c4e0d86a7b0430d8cdb78070b4c55a")
+
+# NIST SP 800-38A F.5.1, CTR-AES128.Encrypt, first block
+CTR_KEY = bytes.fromhex("2b7e151628aed2a6abf7158809cf4f3c")
+CTR_COUNTER = bytes.fromhex("f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff")
+CTR_PLAINTEXT = bytes.fromhex("6bc1bee22e409f96e93d7e117393172a")
+CTR_CIPHERTEXT = bytes.fromhex("874d6191b620e3261bef6864990db6ce")
+
+
+def use(backend):
+    """
+    Makes ``en_crypto`` use ``backend``
+    """
+    en_crypto.backend = backend
+
+
+def known_answers(backend):
+    """
+    :return: list of the names of the known answer checks ``backend`` fails
+    """
+    use(backend)
+    key = ENKeys(metadata=EN_METADATA, tek=EN_TEK, enin=EN_ENIN)
+    key.rpi = key.get_rpi(EN_ENIN)
+    checks = {
+        "HKDF RFC 5869": backend.hkdf_sha256(HKDF_IKM, b"", len(HKDF_OKM)) == HKDF_OKM,
+        "AES FIPS-197": backend.aes_ecb(AES_KEY, AES_PLAINTEXT) == AES_CIPHERTEXT,
+        "AES-CTR SP 800-38A": backend.aes_ctr(CTR_KEY, CTR_COUNTER, CTR_PLAINTEXT) == CTR_CIPHERTEXT,
+        "EN RPIK": key.rpik == EN_RPIK,
+        "EN AEMK": key.aemk == EN_AEMK,
+        "EN RPI": key.rpi == EN_RPI,
+        "EN RPI sequence": key.get_rpi_sequence()[0] == EN_RPI,
+        "EN AEM": key.get_aem() == EN_AEM,
+        "EN AEM decryption": key.decrypt_aems([(EN_RPI, EN_AEM)]) == [EN_METADATA],
+    }
+    return [name for name, passed in checks.items() if not passed]
+
+
+def derive(backend, keys):
+    """
+    :return: the RPI sequence and the AEM of the first interval of every key, derived with ``backend``
+    """
+    use(backend)
+    results = []
+    for tek, enin in keys:
+        key = ENKeys(metadata=EN_METADATA, tek=tek, enin=enin)
+        results.append((key.get_rpi_sequence(), key.get_aem()))
+    return results
+
+
+def measure(function, runs):
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="number of measurements to take the median of")
+    parser.add_argument("--keys", type=int, default=200, help="number of diagnosis keys per measurement")
+    args = parser.parse_args()
+
+    backends = crypto_backend.available()
+    if not backends:
+        sys.exit("No crypto backend is installed")
+
+    failed = False
+    for backend in backends:
+        failures = known_answers(backend)
+        print(f"{backend.name:<14} known answers: {'FAILED ' + ', '.join(failures) if failures else 'ok'}")
+        failed = failed or bool(failures)
+
+    keys = [(os.urandom(16), TEK_ROLLING_PERIOD * (18000 + i)) for i in range(args.keys)]
+    reference = derive(backends[0], keys)
+    for backend in backends[1:]:
+        equal = derive(backend, keys) == reference
+        print(f"{backend.name:<14} RPIs and AEMs equal to {backends[0].name}: {'yes' if equal else 'NO'}")
+        failed = failed or not equal
+    if failed:
+        sys.exit("Backends disagree, not benchmarking")
+
+    print(f"\nMedian of {args.runs} runs over {args.keys} keys, microseconds per key")
+    print(f"  {'backend':<14} {'HKDF x2':>9} {'RPIs':>9} {'per RPI':>9} {'AEM':>9} {'match':>9}")
+    for backend in backends:
+        use(backend)
+        objects = [ENKeys(metadata=EN_METADATA, tek=tek, enin=enin) for tek, enin in keys]
+        hkdf = measure(lambda: [(backend.hkdf_sha256(tek, b"EN-RPIK"), backend.hkdf_sha256(tek, b"EN-AEMK"))
+                                for tek, _ in keys], args.runs)
+        sequence = measure(lambda: [key.get_rpi_sequence() for key in objects], args.runs)
+        # The RPIs derived one call at a time, as before the backends could encrypt them in one batch
+        per_rpi = measure(lambda: [[key.get_rpi(enin) for enin in range(key.tek_period, key.tek_period + 144)]
+                                   for key in objects], args.runs)
+        aem = measure(lambda: [key.get_aem() for key in objects], args.runs)
+        match = measure(lambda: [crypto_backend.match_workload(backend, tek, enin) for tek, enin in keys], args.runs)
+        print(f"  {backend.name:<14}" + "".join(f" {duration / args.keys * 1e6:9.1f}"
+                                                for duration in (hkdf, sequence, per_rpi, aem, match)))
+
+    selected = crypto_backend.select("auto")
+    print(f"\nSelected by \"auto\": {selected.name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Startup benchmark for the client.
+
+Reports the import cost of each of the app's modules and of the heavy third party packages, measured with
+``python -X importtime`` in a fresh interpreter, and the time from launching ``app.py`` until its first page has
+loaded in the window.
+
+Usage: ``python bench_startup.py [--runs 5] [--no-window]``
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULES = ["app", "en_bluetooth", "en_crypto", "crypto_backend", "en_diagnosis", "en_positive", "keyset", "telemetry",
+           "config"]
+PACKAGES = ["flask", "webview", "bluetooth", "Crypto", "cryptography", "websockets"]
+
+
+def import_times(module):
+    """
+    Imports ``module`` in a fresh interpreter
+
+    :return: a dictionary of the cumulative import time of every module imported, directly or by another module, in
+        milliseconds
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=HERE, capture_output=True, text=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Modules imported by other modules are indented under them, they are kept so heavy packages pulled in
+        # indirectly are found
+        times[name.strip()] = int(cumulative) / 1000
+    if result.returncode != 0:
+        times["error"] = result.stderr.strip().splitlines()[-1]
+    return times
+
+
+def time_to_first_window():
+    """
+    Launches the app and waits until it reports its first page has loaded
+
+    :return: seconds from launch to the first loaded page, or None if the window never appeared
+    """
+    env = dict(os.environ, CORONOMO_STARTUP_BENCHMARK="1")
+    start = time.time()
+    process = subprocess.Popen([sys.executable, "app.py"], cwd=HERE, env=env, stdout=subprocess.PIPE, text=True)
+    try:
+        for line in process.stdout:
+            if line.startswith("first window "):
+                return float(line.split()[-1]) - start
+    finally:
+        process.terminate()
+        process.wait()
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="number of measurements to take the median of")
+    parser.add_argument("--no-window", action="store_true", help="only measure import costs")
+    args = parser.parse_args()
+
+    print("Import cost (median cumulative ms)")
+    for module in MODULES:
+        runs = [import_times(module) for _ in range(args.runs)]
+        if "error" in runs[0]:
+            print(f"  {module:<14} failed: {runs[0]['error']}")
+            continue
+        total = statistics.median(run.get(module, 0) for run in runs)
+        heavy = [package for package in PACKAGES if package in runs[0]]
+        print(f"  {module:<14} {total:8.1f}   pulls in: {', '.join(heavy) or '-'}")
+
+    for package in PACKAGES:
+        runs = [import_times(package) for _ in range(args.runs)]
+        if "error" in runs[0]:
+            print(f"  {package:<14} not installed")
+        else:
+            print(f"  {package:<14} {statistics.median(run.get(package, 0) for run in runs):8.1f}")
+
+    if not args.no_window:
+        runs = [time_to_first_window() for _ in range(args.runs)]
+        runs = [run for run in runs if run is not None]
+        if runs:
+            print(f"Time to first window: {statistics.median(runs) * 1000:.0f} ms (median of {len(runs)})")
+        else:
+            print("Time to first window: the window did not appear")
+
+
+if __name__ == "__main__":
+    main()
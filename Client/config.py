@@ -8,3 +8,26 @@ def websocket_info():
     host = "192.168.193.135"
     port = "8765"
     return(host, port)
+
+
+def region_info():
+    """
+    Retrieves the regions whose diagnosis keys this device downloads
+
+    :return: a tuple containing the home region, which is also sent with uploaded keys, and a list of regions the
+        user has travelled to
+    """
+    home_region = "AU-SA"
+    travel_regions = []
+    return(home_region, travel_regions)
+
+
+def crypto_info():
+    """
+    Retrieves the crypto backend used to derive keys and identifiers
+
+    :return: the name of a backend in ``crypto_backend.BACKENDS``, or "auto" to time the installed backends at
+        startup and use the fastest
+    """
+    backend = "auto"
+    return backend
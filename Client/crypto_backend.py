@@ -0,0 +1,204 @@
+"""
+Interchangeable implementations of the cryptographic primitives used by ``en_crypto``.
+
+Matching derives 144 RPIs for every diagnosis key, so the fixed Python-level cost of setting up a key derivation or a
+cipher adds up quickly. Each backend implements the same four primitives on plain bytes:
+
+- ``PyCryptodomeBackend`` uses PyCryptodome, as the app always has
+- ``CryptographyBackend`` uses ``cryptography``, which calls OpenSSL and so uses AES-NI where the CPU has it
+- ``StdlibBackend`` derives keys with HKDF built from ``hmac`` and ``hashlib``, which avoids the per-call setup of
+  either library's HKDF, and uses the fastest available library for AES, since the standard library has no AES
+
+``select`` returns the backend named in the configuration, or with ``"auto"`` times every available backend on the
+work done to match one diagnosis key and returns the fastest.
+"""
+import abc
+import hashlib
+import hmac
+import os
+import time
+
+# Number of matching workloads timed per backend when picking the fastest
+AUTO_SELECT_ROUNDS = 20
+
+
+class Backend(abc.ABC):
+    """
+    Interface of a crypto backend. Constructing a backend imports the libraries it needs and raises ImportError if
+    they are not installed.
+    """
+    name = None
+
+    @abc.abstractmethod
+    def hkdf_sha256(self, key_material, info, length=16):
+        """
+        HKDF (RFC 5869) with SHA-256 and no salt
+
+        :param key_material: input keying material
+        :param info: context and application specific information
+        :param length: length of the output key in bytes
+        :return: the output key
+        """
+
+    @abc.abstractmethod
+    def aes_ecb(self, key, data):
+        """
+        Encrypts any number of 16 byte blocks with one AES-128 cipher in ECB mode
+
+        :param key: 16 byte key
+        :param data: the blocks, concatenated
+        :return: the encrypted blocks, concatenated
+        """
+
+    @abc.abstractmethod
+    def aes_ctr(self, key, counter, data):
+        """
+        Encrypts ``data`` with AES-128 in CTR mode, using the whole 16 byte ``counter`` as the initial counter block
+        """
+
+    def random_bytes(self, length):
+        return os.urandom(length)
+
+
+class PyCryptodomeBackend(Backend):
+    name = "pycryptodome"
+
+    def __init__(self):
+        from Crypto.Cipher import AES
+        from Crypto.Hash import SHA256
+        from Crypto.Protocol.KDF import HKDF
+        from Crypto.Random import get_random_bytes
+
+        self._aes, self._sha256, self._hkdf, self._random = AES, SHA256, HKDF, get_random_bytes
+
+    def hkdf_sha256(self, key_material, info, length=16):
+        return self._hkdf(master=key_material, salt=None, context=info, key_len=length, hashmod=self._sha256)
+
+    def aes_ecb(self, key, data):
+        return self._aes.new(key=key, mode=self._aes.MODE_ECB).encrypt(data)
+
+    def aes_ctr(self, key, counter, data):
+        return self._aes.new(key=key, initial_value=counter, mode=self._aes.MODE_CTR, nonce=b'').encrypt(data)
+
+    def random_bytes(self, length):
+        return self._random(length)
+
+
+class CryptographyBackend(Backend):
+    name = "cryptography"
+
+    def __init__(self):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+        self._hashes, self._cipher, self._algorithms, self._modes, self._hkdf = hashes, Cipher, algorithms, modes, HKDF
+
+    def hkdf_sha256(self, key_material, info, length=16):
+        return self._hkdf(algorithm=self._hashes.SHA256(), length=length, salt=None, info=info).derive(key_material)
+
+    def aes_ecb(self, key, data):
+        encryptor = self._cipher(self._algorithms.AES(key), self._modes.ECB()).encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+
+    def aes_ctr(self, key, counter, data):
+        encryptor = self._cipher(self._algorithms.AES(key), self._modes.CTR(counter)).encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+
+
+class StdlibBackend(Backend):
+    name = "stdlib"
+
+    def __init__(self, aes=None):
+        """
+        :param aes: backend used for AES, by default the first of ``cryptography`` and PyCryptodome installed
+        """
+        if aes is None:
+            aes = _first_available([CryptographyBackend, PyCryptodomeBackend])
+        self.aes = aes
+
+    def hkdf_sha256(self, key_material, info, length=16):
+        # Extract, with the default salt of a hash length of zeros
+        prk = hmac.digest(b"\x00" * hashlib.sha256().digest_size, key_material, "sha256")
+        # Expand
+        output, block = b"", b""
+        counter = 1
+        while len(output) < length:
+            block = hmac.digest(prk, block + info + bytes([counter]), "sha256")
+            output += block
+            counter += 1
+        return output[:length]
+
+    def aes_ecb(self, key, data):
+        return self.aes.aes_ecb(key, data)
+
+    def aes_ctr(self, key, counter, data):
+        return self.aes.aes_ctr(key, counter, data)
+
+
+BACKENDS = {backend.name: backend for backend in (PyCryptodomeBackend, CryptographyBackend, StdlibBackend)}
+
+
+def _first_available(backends):
+    for backend in backends:
+        try:
+            return backend()
+        except ImportError:
+            pass
+    raise ImportError("Neither cryptography nor PyCryptodome is installed")
+
+
+def available():
+    """
+    :return: an instance of every backend whose libraries are installed
+    """
+    backends = []
+    for backend in BACKENDS.values():
+        try:
+            backends.append(backend())
+        except ImportError:
+            pass
+    return backends
+
+
+def match_workload(backend, tek=b"\x00" * 16, enin=0):
+    """
+    The crypto work done to check one diagnosis key: deriving its RPIK and AEMK and encrypting its 144 RPIs
+    """
+    rpik = backend.hkdf_sha256(tek, b"EN-RPIK")
+    backend.hkdf_sha256(tek, b"EN-AEMK")
+    blocks = b"".join(b"EN-RPI" + b"\x00" * 6 + (enin + i).to_bytes(4, "little") for i in range(144))
+    return backend.aes_ecb(rpik, blocks)
+
+
+def fastest(backends, rounds=AUTO_SELECT_ROUNDS):
+    """
+    :return: the backend that completes ``rounds`` matching workloads in the least time
+    """
+    def duration(backend):
+        match_workload(backend)  # Warm up
+        start = time.perf_counter()
+        for _ in range(rounds):
+            match_workload(backend)
+        return time.perf_counter() - start
+
+    return min(backends, key=duration)
+
+
+def select(name="auto"):
+    """
+    Creates the crypto backend to use
+
+    :param name: name of a backend in ``BACKENDS``, or ``"auto"`` for the fastest one installed
+    :return: the backend
+    :raise ImportError: if the named backend, or for ``"auto"`` every backend, is not installed
+    """
+    if name != "auto":
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown crypto backend {name!r}, expected one of {', '.join(BACKENDS)} or 'auto'")
+        return BACKENDS[name]()
+
+    backends = available()
+    if not backends:
+        raise ImportError("Neither cryptography nor PyCryptodome is installed")
+    return fastest(backends)
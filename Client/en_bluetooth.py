@@ -12,11 +12,11 @@
 #     - Look up how to connect to the database and insert values into sqlite databases from python (or see en_crypto.py
 #     for examples)
 #     - Whenever you scan a EN Bluetooth Broadcast, store the RPI, AEM and the timestamp (in Unix time) in the
-#     'Exposures' Table
+#     'Exposures' Table, and its RSSI in dBm in the 'rssi' column if the scanner reports one (see en_risk)
 import traceback
 
-import bluetooth
 import sys
+import telemetry
 from en_crypto import ENKeys
 import sqlite3
 from datetime import datetime
@@ -24,7 +24,19 @@ from datetime import timezone
 import time
 
 DATABASE = 'db.sqlite'
-keys = ENKeys()
+keys = None
+
+
+def get_keys():
+    """
+    Loads this device's keys on first use rather than at import, so importing this module does not touch the database
+
+    :return: the ENKeys object used for broadcasting
+    """
+    global keys
+    if keys is None:
+        keys = ENKeys()
+    return keys
 
 
 def send():
@@ -32,7 +44,11 @@ def send():
     Sends Exposure Notification transmission to other devices running the app in range. Transmission includes the RPI
     and AEM.
     """
-    keys.derive_rpi_aem()
+    import bluetooth
+
+    keys = get_keys()
+    with telemetry.timed("derive_rpi_aem"):
+        keys.derive_rpi_aem()
     print("\nSending")
     uuid = "FD6F"
     service_matches = bluetooth.find_service(uuid=uuid)
@@ -52,10 +68,12 @@ def send():
         service_data = b"\x17\x16\xFD\x6F" + keys.rpi + keys.aem
         package = flag + complete_service_uuid + service_data
 
-        sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-        sock.connect((host, port))
-        sock.send(package)
-        sock.close()
+        with telemetry.timed("ble_send"):
+            sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+            sock.connect((host, port))
+            sock.send(package)
+            sock.close()
+        telemetry.count("broadcasts_sent")
 
 
 def receive():
@@ -63,6 +81,8 @@ def receive():
     Receives Exposure Notification transmission from another device. Stores RPI, AEM, and Timestamp in the Exposures
     table of db.sqlite
     """
+    import bluetooth
+
     while True:
         try:
             server_sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
@@ -76,6 +96,7 @@ def receive():
             bluetooth.advertise_service(server_sock, name="Exposure Notification Service", service_id=uuid)
 
             client_sock, address = server_sock.accept()
+            received = time.perf_counter()
 
             data = client_sock.recv(1024)
 
@@ -89,12 +110,17 @@ def receive():
             split_aem = data[27:]
             print(f"{address} sent rpi {split_rpi}")
 
+            # RFCOMM connections do not report the received signal strength, so rssi is left NULL and these sightings
+            # are not risk weighted
             con = sqlite3.connect(DATABASE)
-            with con:
+            with con, telemetry.timed("sqlite_write"):
                 con.execute("INSERT INTO Exposures (rolling_proximity_identifier, associated_encrypted_metadata, "
                             "timestamp) VALUES (?, ?, ?)", (split_rpi, split_aem, timestamp))
                 con.commit()
             con.close()
+            telemetry.record("ble_receive", time.perf_counter() - received)
+            telemetry.count("broadcasts_received")
+            telemetry.count("rows_written")
 
         except Exception:
             print(traceback.format_exc())
@@ -1,15 +1,24 @@
 import time
 import sqlite3
 from struct import pack
-from Crypto.Cipher import AES
-from Crypto.Hash import SHA256
-from Crypto.Random import get_random_bytes
-from Crypto.Protocol.KDF import HKDF
+
+import config
 
 TEK_ROLLING_PERIOD = 144
 DATABASE = 'db.sqlite'
 METADATA = b"01000000000000000000000000000000"
 
+# The crypto backend is chosen on first use by ``_load_crypto``, it is not needed to start the app
+backend = None
+
+
+def _load_crypto():
+    global backend
+    if backend is None:
+        import crypto_backend
+
+        backend = crypto_backend.select(config.crypto_info())
+
 
 class ENKeys:
     """
@@ -34,7 +43,8 @@ class ENKeys:
 
         If a Temporary Exposure key is given, either the EN Interval Number or Timestamp for that key must also be
         provided. Otherwise, a Temporary Exposure Key is auto-generated based on the current time It will forst check
-        the database to see in a key has already been generated for this time.
+        the database to see in a key has already been generated for this time. Old keys and exposures are not removed
+        here, call ``remove_old_db`` for that (the app does so in the background at startup).
 
         local_key indicates whether the generated keys are this devices own keys that will be transmitted to other
         devices. If so, the generated Temporary Exposure Keys will be stored in the local Temporary_Exposure_Keys
@@ -47,6 +57,7 @@ class ENKeys:
         :param local_key:
         """
         self.metadata = metadata
+        _load_crypto()
 
         # If Temporary Exposure Key is not user-defined
         if tek is None or (enin is None and timestamp is None):
@@ -58,7 +69,6 @@ class ENKeys:
             self.tek_period = ENKeys.get_tek_period()
 
             if self.local_key:
-                ENKeys.remove_old_db()
                 tek_exists = False
                 con = sqlite3.connect(DATABASE)
                 with con:
@@ -150,7 +160,8 @@ class ENKeys:
 
         :return: Temporary Exposure Key
         """
-        tek = get_random_bytes(16)
+        _load_crypto()
+        tek = backend.random_bytes(16)
         return tek
 
     def derive_rpi_aem(self):
@@ -199,7 +210,7 @@ class ENKeys:
 
         :return: Rolling Proximity Identifier Key
         """
-        rpik = HKDF(master=self.tek, salt=None, context="EN-RPIK".encode("UTF-8"), key_len=16, hashmod=SHA256)
+        rpik = backend.hkdf_sha256(self.tek, "EN-RPIK".encode("UTF-8"))
         return rpik
 
     def get_aemk(self):
@@ -211,7 +222,7 @@ class ENKeys:
 
         :return: Associated Encrypted Metadata Key
         """
-        aemk = HKDF(master=self.tek, salt=None, context="EN-AEMK".encode("UTF-8"), key_len=16, hashmod=SHA256)
+        aemk = backend.hkdf_sha256(self.tek, "EN-AEMK".encode("UTF-8"))
         return aemk
 
     def get_rpi(self, enin=None):
@@ -228,9 +239,7 @@ class ENKeys:
         """
         if enin is None:
             enin = ENKeys.get_enin()
-        padded_data = "EN-RPI".encode("UTF-8") + b"\x00" * 6 + pack("<I", enin)
-        cipher = AES.new(key=self.rpik, mode=AES.MODE_ECB)
-        rpi = cipher.encrypt(padded_data)
+        rpi = backend.aes_ecb(self.rpik, ENKeys.get_padded_data(enin))
         return rpi
 
     def get_aem(self):
@@ -242,15 +251,55 @@ class ENKeys:
 
         :return: Associated Encrypted Metadata
         """
-        cipher = AES.new(key=self.aemk, initial_value=self.rpi, mode=AES.MODE_CTR, nonce=b'')
-        aem = cipher.encrypt(self.metadata)
+        aem = backend.aes_ctr(self.aemk, self.rpi, self.metadata)
         return aem
 
+    def decrypt_aems(self, rpi_aems):
+        """
+        Decrypts the Associated Encrypted Metadata of several broadcasts made with this Temporary Exposure Key at once.
+
+        Each AEM is encrypted with AES-CTR under the AEMK, with its RPI as the initial counter block. The key streams
+        of all of them are produced by a single AES-ECB call over every counter block, reusing one cipher, and then
+        XORed with the AEMs.
+
+        :param rpi_aems: list of (Rolling Proximity Identifier, Associated Encrypted Metadata) tuples
+        :return: list of the decrypted metadata, in the same order
+        """
+        counters = bytearray()
+        for rpi, aem in rpi_aems:
+            counter = int.from_bytes(rpi, "big")
+            for block in range((len(aem) + 15) // 16):
+                counters += ((counter + block) % (1 << 128)).to_bytes(16, "big")
+
+        key_stream = backend.aes_ecb(self.aemk, bytes(counters))
+
+        metadata = []
+        offset = 0
+        for rpi, aem in rpi_aems:
+            stream = int.from_bytes(key_stream[offset:offset + len(aem)], "big")
+            metadata.append((int.from_bytes(aem, "big") ^ stream).to_bytes(len(aem), "big"))
+            offset += (len(aem) + 15) // 16 * 16
+        return metadata
+
+    @staticmethod
+    def get_padded_data(enin):
+        """
+        :param enin: EN Interval Number
+        :return: the block encrypted with the Rolling Proximity Identifier Key to give the interval's RPI
+        """
+        return "EN-RPI".encode("UTF-8") + b"\x00" * 6 + pack("<I", enin)
+
     def get_rpi_sequence(self):
-        sequence = []
-        for enin in range(self.tek_period, self.tek_period + TEK_ROLLING_PERIOD):
-            rpi = self.get_rpi(enin)
-            sequence.append(rpi)
+        """
+        Generates the Rolling Proximity Identifiers of every EN Interval Number in the key's rolling period. All of
+        them are encrypted with one call to the backend, so the cipher is only set up once.
+
+        :return: list of the Rolling Proximity Identifiers, in order
+        """
+        padded_data = b"".join(ENKeys.get_padded_data(enin)
+                               for enin in range(self.tek_period, self.tek_period + TEK_ROLLING_PERIOD))
+        rpis = backend.aes_ecb(self.rpik, padded_data)
+        sequence = [rpis[i:i + 16] for i in range(0, len(rpis), 16)]
 
         return sequence
 
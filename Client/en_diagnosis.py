@@ -1,88 +1,175 @@
-import asyncio
+import concurrent.futures
 import sqlite3
-import websockets
 import pickle
 import config
-from en_crypto import ENKeys
+import en_risk
+import en_session
+import telemetry
+from en_crypto import ENKeys, TEK_ROLLING_PERIOD
+from keyset import DiagnosisKeySet
 
 DATABASE = 'db.sqlite'
-socket_host, socket_port = config.websocket_info()
+# Most regions and days the server accepts in one refresh
+MAX_REGIONS = 16
+MAX_DAYS = 17
 
 
-def refresh_diagnosis():
+class RefreshError(Exception):
     """
-    Initiates a refresh to update the diagnosis keys.
+    Raised when the server answers a refresh without diagnosis keys, e.g. with "Retry after <seconds>" when it is
+    overloaded. The next refresh will try again.
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    result = asyncio.get_event_loop().run_until_complete(get_diagnosis_keys())
-    return result
 
 
-async def get_diagnosis_keys():
+@telemetry.timed("refresh_diagnosis")
+def refresh_diagnosis(shards=None):
     """
-    Transmits a request to retrieve the diagnosis keys from the server
+    Initiates a refresh to update the diagnosis keys. Uses the app's session with the server if it is connected,
+    otherwise a connection of its own.
 
-    :return: Current Diagnosis Keys
+    :param shards: the ``(region, day)`` shards the server announced new keys for. If given, only those that could
+        match this device's contacts are downloaded.
+    :return: True if there is a match between at least one of the new diagnosis keys and the user's contacts
+    :raise RefreshError: if the server did not send the keys
     """
+    # Newest first, so the days that matter most are the ones kept if there are too many
+    days = sighting_days()[:MAX_DAYS]
+    home_region, travel_regions = config.region_info()
+    regions = ([home_region] + [region for region in travel_regions if region != home_region])[:MAX_REGIONS]
+
+    if shards is not None:
+        regions = [region for region in regions if any(shard[0] == region for shard in shards)]
+        days = sorted(set(days) & {day for _, day in shards}, reverse=True)
+
+    if not days or not regions:
+        return False
+
+    with telemetry.timed("download_diagnosis_keys"):
+        incoming = None
+        if en_session.connected():
+            try:
+                incoming = en_session.session.request({"type": "refresh", "regions": regions, "days": days})
+            except (ConnectionError, concurrent.futures.TimeoutError) as err:
+                print(f"Session refresh failed, retrying on a new connection: {err!r}")
+        if incoming is None:
+            import asyncio
+
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            incoming = asyncio.get_event_loop().run_until_complete(get_diagnosis_keys(regions, days))
+
+    if isinstance(incoming, str):
+        # The server is overloaded and replied with "Retry after <seconds>", or rejected the request
+        raise RefreshError(incoming)
+
+    # The server replies with one serialized key set per region and day
+    diagnosis_keys = DiagnosisKeySet()
+    for shard in pickle.loads(incoming):
+        diagnosis_keys.extend(DiagnosisKeySet.from_bytes(shard))
+    diagnosis_keys.deduplicate()
+    telemetry.count("bytes_downloaded", len(incoming))
+    return check_diagnosis_keys(diagnosis_keys)
+
+
+def sighting_days():
+    """
+    Finds the days on which this device recorded other devices' broadcasts. Diagnosis keys from any other day cannot
+    match, so they are not downloaded.
+
+    Days are counted like the server does, as EN Interval Numbers divided by 144. Exposure timestamps are recorded in
+    local time, so the neighbouring days are included as well.
+
+    :return: list of days, newest first
+    """
+    con = sqlite3.connect(DATABASE)
+    with con:
+        cur = con.execute("SELECT DISTINCT timestamp / 600 / ? FROM Exposures", (TEK_ROLLING_PERIOD,))
+        days = {int(row[0]) + offset for row in cur.fetchall() for offset in (-1, 0, 1)}
+    con.close()
+    return sorted(days, reverse=True)
+
+
+async def get_diagnosis_keys(regions, days):
+    """
+    Transmits a request to retrieve the diagnosis keys of the given regions and days on a connection of its own
+
+    :return: the server's reply
+    """
+    import websockets
+
+    socket_host, socket_port = config.websocket_info()
     uri = "ws://" + socket_host + ":" + socket_port
-    async with websockets.connect(uri) as websocket:
+    async with websockets.connect(uri, max_size=None) as websocket:
 
-        send = pickle.dumps("refresh")
+        send = pickle.dumps(("refresh", regions, days))
 
         await websocket.send(send)
 
         incoming = await websocket.recv()
-        diagnosis_keys = pickle.loads(incoming)
-        print(diagnosis_keys)
-        result = check_diagnosis_keys(diagnosis_keys)
-    return result
+    return incoming
 
 
-def check_diagnosis_keys(diagnosis_keys):
+def check_diagnosis_keys(diagnosis_keys, database=DATABASE):
     """
     Checks if the user has been exposed to any of the diagnosis keys.
 
     For each diagnosis key, generates a sequence of RPIs from the given TEK and EN Interval Number. It then checks if
     any of the RPIs are contained in the user's 'Exposures' table. If so, the Diagnosis Key is added to the
-    'Diagnosis_Keys' table and associations to the contacts are added to the 'Exposures' table.
-    Note: this method has not been tested and probably contains bugs
-    :param diagnosis_keys: A list of diagnosis keys, where each key is a tuple consisting of the Temporary Exposure
-        Key and the EN Interval Number associated with that key.
-    :type diagnosis_keys: list[tuple[bytes, int]]
+    'Diagnosis_Keys' table and associations to the contacts are added to the 'Exposures' table. The risk of the
+    matching contacts is scored straight away and stored with them, see ``en_risk``.
+
+    ``simulate.py`` checks the matches found against a simulated population and measures how long matching takes.
+
+    :param diagnosis_keys: The diagnosis keys, where each key is a tuple consisting of the Temporary Exposure Key and
+        the EN Interval Number associated with that key.
+    :type diagnosis_keys: DiagnosisKeySet or list[tuple[bytes, int]]
+    :param database: path of the app's database
     :return: True if there is a match between at least one of the diagnosis keys and the user's contacts, False
     otherwise.
     """
     match = False
-    con = sqlite3.connect(DATABASE)
-
-    for tek, enin in diagnosis_keys:
-        key = ENKeys(tek=tek, enin=enin)
-        rpis = key.get_rpi_sequence()
-
-        with con:
-            cur = con.cursor()
-            cur.execute("SELECT * FROM Diagnosis_Keys WHERE temporary_exposure_key = ?", (tek,))
-            results = cur.fetchall()
-            
-            if not results:
-                query = "SELECT * FROM Exposures WHERE rolling_proximity_identifier IN ({" \
-                        "})".format(','.join(['?'] * len(rpis)))
-                cur.execute(query, rpis)
-
-                results = cur.fetchall()
-                if results:
-                    match = True
-                    try:
-                        cur.execute("INSERT INTO Diagnosis_Keys (temporary_exposure_key, en_interval_number) VALUES (?, ?)",
-                                    (tek, enin))
-                        diag_key_id = cur.lastrowid
-                        contacts = [(diag_key_id, exposure[0]) for exposure in results]
-                        cur.executemany("INSERT INTO Close_Contacts VALUES (?, ?)", contacts)
-                    except Exception as e:
-                        print(e)
-
-            cur.close()
+    con = sqlite3.connect(database)
+    with con:
+        en_risk.ensure_schema(con.cursor())
+
+    with telemetry.timed("check_diagnosis_keys"):
+        for tek, enin in diagnosis_keys:
+            with telemetry.timed("derive_rpi_sequence"):
+                key = ENKeys(tek=tek, enin=enin)
+                rpis = key.get_rpi_sequence()
+            telemetry.count("keys_processed")
+            telemetry.count("rpis_derived", len(rpis))
+
+            with con:
+                cur = con.cursor()
+                with telemetry.timed("sqlite_query"):
+                    cur.execute("SELECT * FROM Diagnosis_Keys WHERE temporary_exposure_key = ?", (tek,))
+                    results = cur.fetchall()
+
+                if not results:
+                    query = f"SELECT {en_risk.EXPOSURE_COLUMNS} FROM Exposures " \
+                            f"WHERE rolling_proximity_identifier IN ({','.join(['?'] * len(rpis))})"
+                    with telemetry.timed("sqlite_query"):
+                        cur.execute(query, rpis)
+                        results = cur.fetchall()
+
+                    if results:
+                        match = True
+                        telemetry.count("matches")
+                        try:
+                            with telemetry.timed("sqlite_write"):
+                                cur.execute("INSERT INTO Diagnosis_Keys (temporary_exposure_key, en_interval_number) "
+                                            "VALUES (?, ?)", (tek, enin))
+                                diag_key_id = cur.lastrowid
+                                contacts = [(diag_key_id, exposure[0]) for exposure in results]
+                                cur.executemany("INSERT INTO Close_Contacts VALUES (?, ?)", contacts)
+                            telemetry.count("rows_written", 1 + len(contacts))
+                            with telemetry.timed("score_risk"):
+                                en_risk.score(cur, diag_key_id, key, results)
+                        except Exception as e:
+                            print(e)
+
+                cur.close()
 
     con.close()
     return match
@@ -1,11 +1,10 @@
-import asyncio
+import concurrent.futures
 import pickle
 import sqlite3
-import websockets
 import config
+import en_session
 
 DATABASE = 'db.sqlite'
-socket_host, socket_port = config.websocket_info()
 
 
 def positive_otp(otp):
@@ -16,6 +15,20 @@ def positive_otp(otp):
     :return: Whether the keys were successfully uploaded
     """
     diagnosis_keys = get_data()
+
+    if en_session.connected():
+        home_region, _ = config.region_info()
+        try:
+            incoming = en_session.session.request({"type": "upload", "otp": otp, "keys": diagnosis_keys,
+                                                   "region": home_region})
+            print(f"< {incoming}")
+            return incoming == "Insertion successful"
+        except (ConnectionError, concurrent.futures.TimeoutError) as err:
+            # The session dropped or stalled, so upload on a connection of its own rather than lose the keys
+            print(f"Session upload failed, retrying on a new connection: {err!r}")
+
+    import asyncio
+
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     result = asyncio.get_event_loop().run_until_complete(send_diagnosis_keys(otp, diagnosis_keys))
@@ -24,13 +37,17 @@ def positive_otp(otp):
 
 async def send_diagnosis_keys(otp, diagnosis_keys):
     """
-    Transmits the provided one time password and diagnosis keys to the server
+    Transmits the provided one time password and diagnosis keys to the server on a connection of its own
 
     :return: Whether the keys were successfully uploaded
     """
+    import websockets
+
+    socket_host, socket_port = config.websocket_info()
     uri = "ws://" + socket_host + ":" + socket_port
     async with websockets.connect(uri) as websocket:
-        send = pickle.dumps((otp, diagnosis_keys))
+        home_region, _ = config.region_info()
+        send = pickle.dumps((otp, diagnosis_keys, home_region))
 
         await websocket.send(send)
 
@@ -0,0 +1,106 @@
+"""
+Risk scoring of matched diagnosis keys.
+
+Once a diagnosis key has matched some of the user's exposures, the Associated Encrypted Metadata recorded with each
+of those exposures is decrypted to recover the transmit power of the other device. Subtracting the signal strength
+(RSSI) recorded with the sighting gives the attenuation, a rough measure of distance, and each sighting counts for
+``SIGHTING_MINUTES`` weighted by how close the devices were, in the same way as the Exposure Notification framework's
+attenuation buckets.
+
+The RSSI is stored in the ``rssi`` column of ``Exposures``, which is NULL for sightings whose receiver could not
+measure it, such as the RFCOMM receiver in ``en_bluetooth``. The distance of those sightings is unknown, so a key with
+any of them gets no weighted minutes and only its number of sightings is shown.
+
+The result is stored in the ``Exposure_Risk`` table when the key first matches, so pages never have to decrypt or
+score anything again.
+"""
+import telemetry
+
+# Broadcasts are sent and scanned for every 15 minutes, so each sighting stands for up to 15 minutes of contact
+SIGHTING_MINUTES = 15
+# Weight of a sighting with an attenuation (dB) up to each bound. Sightings beyond the last bound count for nothing.
+ATTENUATION_WEIGHTS = ((63, 1.0), (73, 0.5))
+# Columns of Exposures that ``score`` expects, in order
+EXPOSURE_COLUMNS = "Exposures.id, rolling_proximity_identifier, associated_encrypted_metadata, timestamp, rssi"
+
+
+def ensure_schema(cur):
+    """
+    Adds the ``rssi`` column to ``Exposures``, which the app's database predates, and creates ``Exposure_Risk``
+    """
+    if "rssi" not in [column[1] for column in cur.execute("PRAGMA table_info(Exposures)")]:
+        cur.execute("ALTER TABLE Exposures ADD COLUMN rssi INTEGER")
+    cur.execute("CREATE TABLE IF NOT EXISTS Exposure_Risk ("
+                "diagnosis_key_id INTEGER PRIMARY KEY, "
+                "sightings INTEGER NOT NULL, "
+                "weighted_minutes REAL)")
+
+
+def transmit_power(metadata):
+    """
+    Reads the transmit power level from decrypted metadata, see ``ENKeys.__init__`` for its layout
+
+    :param metadata: the decrypted Associated Encrypted Metadata
+    :return: the transmit power in dBm, or None if the metadata is too short
+    """
+    try:
+        # The app broadcasts its metadata as hex digits
+        metadata = bytes.fromhex(metadata.decode("ascii"))
+    except ValueError:
+        pass
+    if len(metadata) < 2:
+        return None
+    return int.from_bytes(metadata[1:2], "little", signed=True)
+
+
+def attenuation_weight(attenuation):
+    for bound, weight in ATTENUATION_WEIGHTS:
+        if attenuation <= bound:
+            return weight
+    return 0.0
+
+
+def score(cur, diagnosis_key_id, key, exposures):
+    """
+    Scores and stores the risk of the exposures matching one diagnosis key
+
+    :param cur: cursor of the open transaction that recorded the match, on a database set up by ``ensure_schema``
+    :param diagnosis_key_id: ID of the key in the Diagnosis_Keys table
+    :param key: ENKeys object of the diagnosis key. Its AEMK is derived once and used to decrypt every exposure.
+    :param exposures: the matching rows of the Exposures table, as tuples of ``EXPOSURE_COLUMNS``
+    :return: the attenuation weighted exposure minutes, or None if a sighting has no RSSI or transmit power
+    """
+    minutes = None
+    if all(exposure[4] is not None for exposure in exposures):
+        with telemetry.timed("decrypt_aems"):
+            metadata = key.decrypt_aems([(exposure[1], exposure[2]) for exposure in exposures])
+        telemetry.count("aems_decrypted", len(metadata))
+
+        powers = [transmit_power(item) for item in metadata]
+        if None not in powers:
+            minutes = sum(SIGHTING_MINUTES * attenuation_weight(power - exposure[4])
+                          for power, exposure in zip(powers, exposures))
+
+    cur.execute("INSERT OR REPLACE INTO Exposure_Risk VALUES (?, ?, ?)", (diagnosis_key_id, len(exposures), minutes))
+    return minutes
+
+
+def score_missing(cur):
+    """
+    Scores the diagnosis keys that matched before their risk was stored
+
+    :param cur: cursor of an open transaction
+    :return: the number of keys scored
+    """
+    from en_crypto import ENKeys
+
+    ensure_schema(cur)
+    cur.execute("SELECT id, temporary_exposure_key, en_interval_number FROM Diagnosis_Keys "
+                "WHERE id NOT IN (SELECT diagnosis_key_id FROM Exposure_Risk)")
+    missing = cur.fetchall()
+    for diagnosis_key_id, tek, enin in missing:
+        cur.execute(f"SELECT {EXPOSURE_COLUMNS} FROM Exposures "
+                    "JOIN Close_Contacts ON Close_Contacts.exposure_id = Exposures.id "
+                    "WHERE Close_Contacts.diagnosis_key_id = ?", (diagnosis_key_id,))
+        score(cur, diagnosis_key_id, ENKeys(tek=tek, enin=enin), cur.fetchall())
+    return len(missing)
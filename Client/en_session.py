@@ -0,0 +1,209 @@
+"""
+Persistent connection to the server.
+
+Rather than opening a new connection for every request, the app keeps one connection open on a background thread.
+Requests carry an ID so several can share the connection at once, keepalive pings detect dead connections, and the
+server pushes a ``new_batch`` message as soon as new diagnosis keys are published for one of this device's regions,
+so the app only downloads keys when there is something new. On reconnecting, the session tells the server the last
+snapshot version the app has all the keys of, and the server answers with just the shards changed since, so a
+restarting server does not make every client download everything again.
+"""
+import concurrent.futures
+import itertools
+import pickle
+import threading
+import traceback
+
+import config
+
+# Seconds to wait before reconnecting after consecutive failures
+RECONNECT_DELAYS = (1, 2, 5, 10, 30, 60)
+REQUEST_TIMEOUT = 60
+PING_INTERVAL = 20
+PING_TIMEOUT = 20
+
+session = None
+
+
+class Session(threading.Thread):
+    """
+    A thread running an event loop that keeps a connection to the server open, reconnecting whenever it drops
+    """
+    def __init__(self, regions, on_connect=None, on_new_batch=None):
+        """
+        :param regions: regions to receive ``new_batch`` messages for
+        :param on_connect: called on a new thread when the connection is established while the app has not seen any
+            snapshot version, to download every key. Returns True if it did.
+        :param on_new_batch: called on a new thread with the list of ``(region, day)`` shards that have new keys.
+            Returns True if they were downloaded.
+        """
+        super().__init__(name="coronomo-session", daemon=True)
+        self.regions = regions
+        self.on_connect = on_connect
+        self.on_new_batch = on_new_batch
+        self.connected = threading.Event()
+        self.loop = None
+        self._websocket = None
+        self._pending = {}
+        self._ids = itertools.count(1)
+        # Newest snapshot version whose keys the app has all downloaded, sent with every subscribe
+        self.version = None
+        self._version_lock = threading.Lock()
+        self._callbacks_running = 0
+        self._newest_handled = None
+        self._callback_failed = False
+
+    def run(self):
+        import asyncio
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._run())
+
+    def _callback(self, function, *args, version=None):
+        """
+        Calls ``function`` on a new thread, for the keys of snapshot ``version``, see ``_finished``
+        """
+        if function is None:
+            return
+        with self._version_lock:
+            self._callbacks_running += 1
+
+        def run():
+            handled = False
+            try:
+                handled = function(*args)
+            finally:
+                self._finished(handled, version)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _finished(self, handled, version):
+        """
+        Records that a callback has finished. Once no callback is running, the newest version handled becomes the
+        session's version, unless a callback failed since the last subscribe: its keys would be skipped, so the
+        version stays where it was until the next subscribe asks for them again.
+        """
+        with self._version_lock:
+            self._callbacks_running -= 1
+            if not handled:
+                self._callback_failed = True
+            elif version is not None and (self._newest_handled is None or version > self._newest_handled):
+                self._newest_handled = version
+            if not self._callbacks_running and not self._callback_failed and self._newest_handled is not None:
+                self.version = self._newest_handled
+
+    def _subscribed(self, message):
+        if message["shards"] is None:
+            # The server does not know what the app has, so download everything
+            self._callback(self.on_connect, version=message["version"])
+        elif message["shards"]:
+            self._callback(self.on_new_batch, message["shards"], version=message["version"])
+        else:
+            with self._version_lock:
+                self._callbacks_running += 1
+            self._finished(True, message["version"])
+
+    async def _run(self):
+        import asyncio
+        import websockets
+
+        socket_host, socket_port = config.websocket_info()
+        uri = "ws://" + socket_host + ":" + socket_port
+        failures = 0
+
+        while True:
+            try:
+                async with websockets.connect(uri, ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT,
+                                              max_size=None) as websocket:
+                    with self._version_lock:
+                        self._newest_handled, self._callback_failed = None, False
+                    await websocket.send(pickle.dumps({"type": "subscribe", "regions": self.regions,
+                                                       "version": self.version}))
+                    self._websocket = websocket
+                    self.connected.set()
+                    failures = 0
+
+                    async for incoming in websocket:
+                        message = pickle.loads(incoming)
+                        if message.get("type") == "subscribed":
+                            self._subscribed(message)
+                        elif message.get("type") == "new_batch":
+                            self._callback(self.on_new_batch, message["shards"], version=message["version"])
+                        else:
+                            future = self._pending.pop(message.get("id"), None)
+                            if future is not None and not future.done():
+                                future.set_result(message)
+
+            except Exception:
+                print(traceback.format_exc())
+
+            finally:
+                self.connected.clear()
+                self._websocket = None
+                for future in self._pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("Connection to the server was lost"))
+                self._pending.clear()
+
+            await asyncio.sleep(RECONNECT_DELAYS[min(failures, len(RECONNECT_DELAYS) - 1)])
+            failures += 1
+
+    async def _request(self, message):
+        if self._websocket is None:
+            raise ConnectionError("Not connected to the server")
+
+        import websockets
+
+        request_id = next(self._ids)
+        future = self.loop.create_future()
+        self._pending[request_id] = future
+        try:
+            await self._websocket.send(pickle.dumps(dict(message, id=request_id)))
+            return await future
+        except websockets.ConnectionClosed as err:
+            raise ConnectionError("Connection to the server was lost") from err
+        finally:
+            # Also when the request is cancelled after timing out, so no reply is waited for forever
+            self._pending.pop(request_id, None)
+
+    def request(self, message, timeout=REQUEST_TIMEOUT):
+        """
+        Sends a request over the session and waits for the reply. Must not be called from the session's own thread.
+
+        :param message: request dictionary, see ``session_load`` in the server
+        :param timeout: seconds to wait for the reply
+        :return: the reply, as the server would send it to a single request on its own connection
+        :raise ConnectionError: if the session is not connected or the connection is lost before the reply
+        :raise concurrent.futures.TimeoutError: if there is no reply within ``timeout`` seconds
+        """
+        import asyncio
+
+        if not self.connected.is_set():
+            raise ConnectionError("Not connected to the server")
+        future = asyncio.run_coroutine_threadsafe(self._request(message), self.loop)
+        try:
+            reply = future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+        if "error" in reply:
+            raise ValueError(reply["error"])
+        return reply["reply"]
+
+
+def start(regions, on_connect=None, on_new_batch=None):
+    """
+    Starts the app's session with the server, see ``Session``
+    """
+    global session
+    session = Session(regions, on_connect, on_new_batch)
+    session.start()
+    return session
+
+
+def connected():
+    """
+    :return: True if the app's session is currently connected
+    """
+    return session is not None and session.connected.is_set()
@@ -0,0 +1,189 @@
+"""
+Compact container for diagnosis keys.
+
+A list of ``(tek, enin)`` tuples costs over 150 bytes of Python objects per key to hold 20 bytes of data.
+``DiagnosisKeySet`` keeps the Temporary Exposure Keys back to back in one ``bytearray`` and their EN Interval Numbers
+in a parallel ``array('I')``, so a million keys take about 20 MB. The same layout is used on the wire: a header with
+the number of keys, followed by the keys and then the EN Interval Numbers, little-endian. This module is shared by the
+server and the app and must be kept the same in both.
+"""
+import io
+import pickle
+import struct
+import sys
+from array import array
+
+TEK_LENGTH = 16
+# Magic bytes and number of keys
+HEADER = struct.Struct("<4sI")
+MAGIC = b"DKS1"
+# Free slot of the hash table used by ``deduplicate``
+_EMPTY = 0xFFFFFFFF
+
+
+class DiagnosisKeySet:
+    """
+    A sequence of diagnosis keys. Indexing and iterating give ``(tek, enin)`` tuples, created one at a time as they
+    are needed, and slicing gives a new set.
+    """
+    def __init__(self, teks=b"", enins=()):
+        """
+        :param teks: the Temporary Exposure Keys, concatenated
+        :param enins: the EN Interval Number of each key
+        """
+        self.teks = bytearray(teks)
+        self.enins = array("I", enins)
+        if len(self.teks) != len(self.enins) * TEK_LENGTH:
+            raise ValueError(f"{len(self.teks)} bytes of keys do not match {len(self.enins)} EN Interval Numbers")
+
+    @classmethod
+    def from_keys(cls, diagnosis_keys):
+        """
+        :param diagnosis_keys: iterable of ``(tek, enin)`` tuples
+        """
+        keys = cls()
+        for tek, enin in diagnosis_keys:
+            keys.append(tek, enin)
+        return keys
+
+    def append(self, tek, enin):
+        if len(tek) != TEK_LENGTH:
+            raise ValueError(f"Temporary Exposure Keys must be {TEK_LENGTH} bytes, not {len(tek)}")
+        self.teks += tek
+        self.enins.append(enin)
+
+    def extend(self, other):
+        """
+        Appends every key of another ``DiagnosisKeySet``
+        """
+        self.teks += other.teks
+        self.enins.extend(other.enins)
+
+    def tek(self, index):
+        start = index * TEK_LENGTH
+        return bytes(self.teks[start:start + TEK_LENGTH])
+
+    def __len__(self):
+        return len(self.enins)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return DiagnosisKeySet(self.teks[start * TEK_LENGTH:stop * TEK_LENGTH], self.enins[start:stop])
+            return DiagnosisKeySet.from_keys(self[i] for i in range(start, stop, step))
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("diagnosis key index out of range")
+        return self.tek(index), self.enins[index]
+
+    def __iter__(self):
+        teks = memoryview(self.teks)
+        for index, enin in enumerate(self.enins):
+            yield bytes(teks[index * TEK_LENGTH:(index + 1) * TEK_LENGTH]), enin
+
+    def __eq__(self, other):
+        if not isinstance(other, DiagnosisKeySet):
+            return NotImplemented
+        return self.teks == other.teks and self.enins == other.enins
+
+    def __repr__(self):
+        return f"<DiagnosisKeySet of {len(self)} keys>"
+
+    def deduplicate(self):
+        """
+        Removes repeated keys in place, keeping the first of each in its original order. Keys already seen are found
+        with an open addressing hash table of their indexes in an ``array('I')``, so apart from the table, which takes
+        8 to 16 bytes per key, no memory is held per key.
+
+        :return: this set
+        """
+        count = len(self)
+        # At most half full, so probe sequences stay short
+        mask = (1 << (2 * count).bit_length()) - 1
+        table = array("I", [_EMPTY]) * (mask + 1)
+        enins = self.enins
+        kept = 0
+        with memoryview(self.teks) as teks:
+            for index in range(count):
+                tek = bytes(teks[index * TEK_LENGTH:(index + 1) * TEK_LENGTH])
+                enin = enins[index]
+                slot = hash((tek, enin)) & mask
+                while True:
+                    other = table[slot]
+                    if other == _EMPTY:
+                        # Move the key down over the repeated keys removed before it
+                        table[slot] = kept
+                        teks[kept * TEK_LENGTH:(kept + 1) * TEK_LENGTH] = tek
+                        enins[kept] = enin
+                        kept += 1
+                        break
+                    if enins[other] == enin and teks[other * TEK_LENGTH:(other + 1) * TEK_LENGTH] == tek:
+                        break
+                    slot = (slot + 1) & mask
+        del self.teks[kept * TEK_LENGTH:]
+        del self.enins[kept:]
+        return self
+
+    def to_bytes(self):
+        """
+        :return: the keys in the wire format
+        """
+        enins = self.enins
+        if sys.byteorder == "big":
+            enins = array("I", enins)
+            enins.byteswap()
+        return HEADER.pack(MAGIC, len(self)) + self.teks + enins.tobytes()
+
+    def to_pickled_list(self):
+        """
+        Serializes the keys as a pickled list of ``(tek, enin)`` tuples, as they were sent before key sets, for
+        clients that do not know the wire format. The tuples are pickled in batches as they are created, so they are
+        never all held at once.
+
+        :return: the pickled list
+        """
+        buffer = io.BytesIO()
+        pickler = pickle.Pickler(buffer)
+        # Without the memo the pickler does not keep every tuple alive, the tuples hold no shared objects
+        pickler.fast = True
+        pickler.dump(_PickledAsList(self))
+        return buffer.getvalue()
+
+    @staticmethod
+    def is_serialized(data):
+        """
+        :return: True if ``data`` starts like the output of ``to_bytes``
+        """
+        return data[:len(MAGIC)] == MAGIC
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :param data: keys in the wire format, see ``to_bytes``
+        :raise ValueError: if ``data`` is not a serialized key set
+        """
+        if len(data) < HEADER.size or not cls.is_serialized(data):
+            raise ValueError("Not a serialized diagnosis key set")
+        _, count = HEADER.unpack_from(data)
+        end = HEADER.size + count * TEK_LENGTH
+        if len(data) != end + count * 4:
+            raise ValueError(f"Serialized diagnosis key set of {count} keys has {len(data)} bytes")
+
+        keys = cls()
+        keys.teks = bytearray(data[HEADER.size:end])
+        keys.enins.frombytes(data[end:])
+        if sys.byteorder == "big":
+            keys.enins.byteswap()
+        return keys
+
+
+class _PickledAsList:
+    def __init__(self, items):
+        self.items = items
+
+    def __reduce__(self):
+        # Unpickles as an empty list extended with the items
+        return list, (), None, iter(self.items)
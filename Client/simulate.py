@@ -0,0 +1,231 @@
+"""
+Deterministic population simulator for the client's matching pipeline.
+
+Generates a population of devices with a Temporary Exposure Key for every day, and records encounters between this
+device and randomly chosen members of the population, as the bluetooth receiver would, in the ``Exposures`` table of
+a temporary database with the app's schema. A fraction of the population then tests positive. Their keys, mixed with the
+keys of strangers that were never encountered, make up the diagnosis keys that ``check_diagnosis_keys`` is run on.
+
+Afterwards the database is checked: every positive device that was encountered must have been matched, with exactly
+the exposures recorded for it, and no other key may have matched. The time taken, the peak memory and the bytes the
+process read and wrote are reported. The same seed always produces the same population, encounters and keys.
+
+Usage: ``python simulate.py [--keys 10000] [--sightings 1000] [--devices 1000] [--positive 0.05] [--seed 1]``
+"""
+import argparse
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import en_crypto
+import en_diagnosis
+import en_risk
+import telemetry
+from en_crypto import ENKeys, TEK_ROLLING_PERIOD
+from keyset import DiagnosisKeySet
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Day number (days since the Unix Epoch) of the first simulated day
+START_DAY = 19000
+
+
+class Population:
+    """
+    Devices with one Temporary Exposure Key per day, all drawn from ``rng``
+    """
+    def __init__(self, rng, devices, days):
+        self.devices = devices
+        self.days = days
+        self.teks = [[rng.randbytes(16) for _ in range(days)] for _ in range(devices)]
+        # Measured transmit power in dBm of each device, to vary the risk scores
+        self.powers = [rng.randint(-20, 0) for _ in range(devices)]
+
+    @staticmethod
+    def enin(day):
+        return (START_DAY + day) * TEK_ROLLING_PERIOD
+
+    def keys(self, device):
+        """
+        :return: the diagnosis keys the device uploads after testing positive
+        """
+        return [(tek, Population.enin(day)) for day, tek in enumerate(self.teks[device])]
+
+
+def create_database(path):
+    """
+    Creates an empty database at ``path`` with the same tables as the app's database
+    """
+    schema = sqlite3.connect(os.path.join(HERE, en_diagnosis.DATABASE))
+    statements = [row[0] for row in schema.execute("SELECT sql FROM sqlite_master "
+                                                   "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'")]
+    schema.close()
+
+    con = sqlite3.connect(path)
+    with con:
+        for statement in statements:
+            con.execute(statement)
+        en_risk.ensure_schema(con.cursor())
+    con.close()
+
+
+def record_encounters(rng, population, sightings, database):
+    """
+    Records ``sightings`` broadcasts from randomly chosen devices, days and EN intervals
+
+    :return: dictionary mapping the TEK of every device and day encountered to the set of IDs of its exposures
+    """
+    keys = {}
+    encounters = {}
+    con = sqlite3.connect(database)
+    with con:
+        for _ in range(sightings):
+            device, day = rng.randrange(population.devices), rng.randrange(population.days)
+            enin = Population.enin(day) + rng.randrange(TEK_ROLLING_PERIOD)
+
+            key = keys.get((device, day))
+            if key is None:
+                metadata = bytes([0x40, population.powers[device] & 0xff, 0, 0])
+                key = keys[device, day] = ENKeys(metadata=metadata, tek=population.teks[device][day],
+                                                 enin=Population.enin(day))
+            key.rpi = key.get_rpi(enin)
+            timestamp = enin * 600 + rng.randrange(600)
+            rssi = rng.randint(-90, -40)
+
+            cur = con.execute("INSERT INTO Exposures (rolling_proximity_identifier, associated_encrypted_metadata, "
+                              "timestamp, rssi) VALUES (?, ?, ?, ?)", (key.rpi, key.get_aem(), timestamp, rssi))
+            encounters.setdefault(key.tek, set()).add(cur.lastrowid)
+    con.close()
+    return encounters
+
+
+def diagnosis_keys(rng, population, positive, count):
+    """
+    Chooses the devices that test positive and mixes their keys with keys of strangers, up to ``count`` keys
+
+    :return: the diagnosis keys in random order, and the set of devices that tested positive
+    """
+    positives = set(rng.sample(range(population.devices), round(population.devices * positive)))
+    keys = [key for device in sorted(positives) for key in population.keys(device)]
+    keys += [(rng.randbytes(16), Population.enin(rng.randrange(population.days)))
+             for _ in range(count - len(keys))]
+    rng.shuffle(keys)
+    return DiagnosisKeySet.from_keys(keys), positives
+
+
+def check(database, expected):
+    """
+    Compares the matches recorded in the database with the expected ones
+
+    :param expected: dictionary mapping each TEK that should match to the set of IDs of its exposures
+    :return: list of descriptions of the differences, empty if the matches are correct
+    """
+    con = sqlite3.connect(database)
+    found = {}
+    cur = con.execute("SELECT temporary_exposure_key, exposure_id FROM Diagnosis_Keys "
+                      "LEFT JOIN Close_Contacts ON Close_Contacts.diagnosis_key_id = Diagnosis_Keys.id")
+    for tek, exposure_id in cur:
+        found.setdefault(tek, set()).add(exposure_id)
+    scored = con.execute("SELECT COUNT(*) FROM Exposure_Risk").fetchone()[0] if found else 0
+    unweighted = con.execute("SELECT COUNT(*) FROM Exposure_Risk "
+                             "WHERE weighted_minutes IS NULL").fetchone()[0] if found else 0
+    con.close()
+
+    errors = []
+    missed = expected.keys() - found.keys()
+    false = found.keys() - expected.keys()
+    wrong = [tek for tek in expected.keys() & found.keys() if expected[tek] != found[tek]]
+    if missed:
+        errors.append(f"{len(missed)} keys that were encountered did not match")
+    if false:
+        errors.append(f"{len(false)} keys that were never encountered matched")
+    if wrong:
+        errors.append(f"{len(wrong)} matching keys were linked to the wrong exposures")
+    if scored != len(found):
+        errors.append(f"{len(found) - scored} matching keys were not scored")
+    if unweighted:
+        errors.append(f"{unweighted} matching keys have no weighted minutes although every sighting has an RSSI")
+    return errors
+
+
+def io_counters():
+    """
+    :return: the process's I/O counters from ``/proc/self/io``, or None where they are not available
+    """
+    try:
+        with open("/proc/self/io") as file:
+            return {name: int(value) for name, value in (line.split(":") for line in file)}
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--keys", type=int, default=10000, help="number of diagnosis keys to check")
+    parser.add_argument("--sightings", type=int, default=1000, help="number of broadcasts this device received")
+    parser.add_argument("--devices", type=int, default=1000, help="number of devices this device may encounter")
+    parser.add_argument("--days", type=int, default=14, help="number of days the sightings are spread over")
+    parser.add_argument("--positive", type=float, default=0.05, help="fraction of the devices that test positive")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the random number generator")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="trace Python allocations while matching, which is accurate but slows matching down")
+    parser.add_argument("--keep", action="store_true", help="keep the simulated database")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    directory = tempfile.mkdtemp(prefix="coronomo-simulation-")
+    database = os.path.join(directory, "db.sqlite")
+    create_database(database)
+
+    start = time.perf_counter()
+    population = Population(rng, args.devices, args.days)
+    encounters = record_encounters(rng, population, args.sightings, database)
+    keys, positives = diagnosis_keys(rng, population, args.positive, args.keys)
+    positive_teks = {tek for device in positives for tek in population.teks[device]}
+    expected = {tek: ids for tek, ids in encounters.items() if tek in positive_teks}
+    print(f"Simulated {args.devices} devices over {args.days} days in {time.perf_counter() - start:.1f} s: "
+          f"{args.sightings} sightings, {len(keys)} diagnosis keys, {len(expected)} of which were encountered")
+    # Chosen before timing, and even if no key has been derived yet, e.g. with no sightings
+    en_crypto._load_crypto()
+    print(f"Crypto backend: {en_crypto.backend.name}")
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    io_before = io_counters()
+    start = time.perf_counter()
+    en_diagnosis.check_diagnosis_keys(keys, database=database)
+    duration = time.perf_counter() - start
+    io_after = io_counters()
+
+    print(f"Matched {len(keys)} keys in {duration:.2f} s, {len(keys) / duration:.0f} keys/s")
+    timings = telemetry.snapshot()["timings"]
+    for name in ("derive_rpi_sequence", "sqlite_query", "sqlite_write", "score_risk"):
+        if name in timings:
+            print(f"  {name:<20} mean {timings[name]['mean_ms']:.3f} ms, "
+                  f"p95 {timings[name]['p95_ms']:.3f} ms over the last {timings[name]['samples']}")
+    if args.tracemalloc:
+        print(f"Peak traced memory while matching: {tracemalloc.get_traced_memory()[1] / 2 ** 20:.1f} MiB")
+        tracemalloc.stop()
+    print(f"Peak resident memory of the process: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+    if io_before is not None:
+        print("I/O while matching: " + ", ".join(f"{name} {(io_after[name] - io_before[name]) / 2 ** 20:.1f} MiB"
+                                                  for name in ("rchar", "wchar", "read_bytes", "write_bytes")))
+
+    errors = check(database, expected)
+    if args.keep:
+        print(f"Simulated database kept at {database}")
+    else:
+        shutil.rmtree(directory)
+
+    if errors:
+        sys.exit("Incorrect matches: " + "; ".join(errors))
+    print(f"Correct: all {len(expected)} encountered keys matched and no others")
+
+
+if __name__ == "__main__":
+    main()
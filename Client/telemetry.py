@@ -0,0 +1,110 @@
+"""
+Lightweight performance telemetry for the client.
+
+Timings of hot paths and counts of work done are kept in fixed size in-memory ring buffers, so recording costs a
+``perf_counter`` call and a ``deque.append`` and memory use never grows. The buffers are exposed on the
+``/diagnostics`` route of the app.
+"""
+import queue as queue_module
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+RING_SIZE = 256
+
+_timings = defaultdict(lambda: deque(maxlen=RING_SIZE))
+_counts = defaultdict(int)
+_queue = None
+
+
+def record(name, duration, timestamp=None):
+    """
+    Records a single timing
+
+    :param name: name of the measured operation
+    :param duration: how long the operation took, in seconds
+    :param timestamp: when the operation finished in Unix Epoch Time, defaults to now
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    if _queue is not None:
+        _queue.put(("timing", name, duration, timestamp))
+    else:
+        _timings[name].append((timestamp, duration))
+
+
+def count(name, value=1):
+    """
+    Adds ``value`` to the counter ``name``, e.g. the number of diagnosis keys processed
+    """
+    if _queue is not None:
+        _queue.put(("count", name, value, None))
+    else:
+        _counts[name] += value
+
+
+@contextmanager
+def timed(name):
+    """
+    Records how long the enclosed block takes. Can also be used as a function decorator.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def forward_to(queue):
+    """
+    Sends all telemetry recorded in this process to ``queue`` instead of the local buffers. Used by the bluetooth
+    receive process so its timings show up in the app's diagnostics.
+
+    :param queue: a ``multiprocessing`` queue that the app process drains with ``collect``
+    """
+    global _queue
+    _queue = queue
+
+
+def collect(queue):
+    """
+    Moves all telemetry waiting in ``queue`` into the local buffers
+    """
+    while True:
+        try:
+            kind, name, value, timestamp = queue.get_nowait()
+        except queue_module.Empty:
+            break
+        if kind == "timing":
+            _timings[name].append((timestamp, value))
+        else:
+            _counts[name] += value
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def snapshot():
+    """
+    Summarises the recorded telemetry
+
+    :return: a dictionary with summary statistics and the most recent samples of each timing, in milliseconds, and
+        the counters
+    """
+    timings = {}
+    for name, samples in list(_timings.items()):
+        samples = list(samples)
+        if not samples:
+            continue
+        ordered = sorted(duration for _, duration in samples)
+        timings[name] = {
+            "samples": len(ordered),
+            "last_ms": samples[-1][1] * 1000,
+            "mean_ms": sum(ordered) / len(ordered) * 1000,
+            "p50_ms": _percentile(ordered, 0.5) * 1000,
+            "p95_ms": _percentile(ordered, 0.95) * 1000,
+            "max_ms": ordered[-1] * 1000,
+            "recent": [(timestamp, duration * 1000) for timestamp, duration in samples[-20:]],
+        }
+    return {"timings": timings, "counts": dict(_counts)}
@@ -0,0 +1,226 @@
+"""
+Admission control for the websocket server.
+
+Requests of each message type are limited to a number of concurrent requests. Requests that cannot start straight
+away wait in a small bounded queue shared by all types. Each type only waits for its own limit, so a surge of uploads
+never holds up refreshes, which are served from memory. When the queue is full, uploads take the place of waiting
+refreshes. A request that finds the queue full is rejected straight away, and one that has waited ``max_wait`` seconds
+without starting is rejected then, both with a "retry after" reply rather than slowing down every other request.
+Upload attempts are additionally
+rate limited per IP address with a token bucket, which also slows down brute-forcing of one time passwords. The
+buckets are shared by all worker processes, so a client cannot multiply its attempts by the number of workers.
+"""
+import asyncio
+import bisect
+import fcntl
+import hashlib
+import itertools
+import math
+import mmap
+import os
+import struct
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
+
+import metrics
+
+# When the wait queue is full, requests with lower numbers displace waiting requests with higher numbers
+PRIORITIES = {"upload": 0, "refresh": 1}
+# Shared buckets are kept in a table of this many sets of SHARED_WAYS slots. A client's bucket can be in any slot of
+# the set its hash picks, and when the set is full the bucket that was used least recently is forgotten.
+SHARED_SETS = 16384
+SHARED_WAYS = 8
+# Hash of the client, tokens and when the tokens were last updated, on the system wide monotonic clock
+SHARED_SLOT = struct.Struct("<Qdd")
+
+
+class Rejected(Exception):
+    """
+    Raised when a request is not admitted. ``retry_after`` is the number of seconds the client should wait.
+    """
+    def __init__(self, reason, retry_after):
+        super().__init__(f"{reason}, retry after {retry_after} seconds")
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def reply(self):
+        return f"Retry after {self.retry_after}"
+
+
+class SharedTokenBucket:
+    """
+    Per-client token buckets holding up to ``burst`` tokens and refilling at ``rate`` tokens per second. The buckets are
+    kept in a file, normally on tmpfs, that every worker process maps. Each ``take`` locks the file, so this is meant
+    for infrequent requests such as uploads.
+    """
+    def __init__(self, path, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        size = SHARED_SETS * SHARED_WAYS * SHARED_SLOT.size
+        self._file = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._locked():
+            if os.fstat(self._file).st_size != size:
+                os.ftruncate(self._file, size)
+        self._mmap = mmap.mmap(self._file, size)
+
+    @contextmanager
+    def _locked(self):
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def _refill(self, tokens, updated, now):
+        return min(self.burst, tokens + max(0, now - updated) * self.rate)
+
+    def _take(self, tokens, updated, now):
+        """
+        :return: the tokens left after taking one from a bucket holding ``tokens`` at ``updated``
+        :raise Rejected: if the bucket is empty
+        """
+        tokens = self._refill(tokens, updated, now)
+        if tokens < 1:
+            raise Rejected("rate limited", math.ceil((1 - tokens) / self.rate))
+        return tokens - 1
+
+    def take(self, client):
+        """
+        Takes a token from ``client``'s bucket
+
+        :param client: key identifying the client, e.g. its IP address
+        :raise Rejected: if the bucket is empty
+        """
+        key = int.from_bytes(hashlib.blake2b(str(client).encode("UTF-8"), digest_size=8).digest(), "little") or 1
+        first = key % SHARED_SETS * SHARED_WAYS
+        now = time.monotonic()
+
+        with self._locked():
+            # Find the client's slot, or else the least recently used one, empty slots having never been used
+            slot, tokens, updated = None, None, None
+            for offset in range(first * SHARED_SLOT.size, (first + SHARED_WAYS) * SHARED_SLOT.size, SHARED_SLOT.size):
+                stored_key, stored_tokens, stored_updated = SHARED_SLOT.unpack_from(self._mmap, offset)
+                if stored_key == key:
+                    slot, tokens, updated = offset, stored_tokens, stored_updated
+                    break
+                if updated is None or stored_updated < updated:
+                    slot, updated = offset, stored_updated
+            else:
+                tokens, updated = self.burst, now
+
+            try:
+                SHARED_SLOT.pack_into(self._mmap, slot, key, self._take(tokens, updated, now), now)
+            except Rejected:
+                SHARED_SLOT.pack_into(self._mmap, slot, key, self._refill(tokens, updated, now), now)
+                raise
+
+
+class Admission:
+    """
+    Concurrency limits per message type with a shared, bounded, priority ordered wait queue
+    """
+    def __init__(self, limits, max_waiting, max_wait):
+        """
+        :param limits: maximum number of concurrent requests for each message type. Types that are not listed are
+            not limited.
+        :param max_waiting: maximum number of requests waiting to start
+        :param max_wait: maximum number of seconds a request may wait to start
+        """
+        self.limits = limits
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.running = defaultdict(int)
+        self.queued = defaultdict(int)
+        self.waiting = []
+        self._order = itertools.count()
+
+    def _retry_after(self):
+        return max(1, math.ceil(self.max_wait))
+
+    def _reject(self, reason):
+        return Rejected(reason, self._retry_after())
+
+    def _remove(self, entry):
+        index = bisect.bisect_left(self.waiting, entry)
+        if index < len(self.waiting) and self.waiting[index] is entry:
+            del self.waiting[index]
+            self.queued[entry[2]] -= 1
+            metrics.set_gauge("admission_waiting", len(self.waiting))
+            return True
+        return False
+
+    def _dispatch(self):
+        # Start waiting requests of every type that is below its limit, each type in the order its requests arrived
+        for entry in list(self.waiting):
+            kind, future = entry[2], entry[3]
+            if self.running[kind] >= self.limits[kind]:
+                continue
+            self._remove(entry)
+            self.running[kind] += 1
+            future.set_result(True)
+
+    def _expire(self, entry):
+        if self._remove(entry):
+            entry[3].set_exception(self._reject("timed out"))
+
+    async def acquire(self, kind):
+        """
+        Waits until a request of type ``kind`` may start
+
+        :raise Rejected: if the queue is full or the request waited too long
+        """
+        if kind not in self.limits:
+            return
+
+        priority = PRIORITIES.get(kind, len(PRIORITIES))
+        if self.running[kind] < self.limits[kind] and not self.queued[kind]:
+            self.running[kind] += 1
+            return
+
+        if len(self.waiting) >= self.max_waiting:
+            # Make room by turning away the lowest priority waiting request, unless this one is no more important
+            worst = self.waiting[-1]
+            if worst[0] <= priority:
+                raise self._reject("queue full")
+            self._remove(worst)
+            worst[3].set_exception(self._reject("displaced"))
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        entry = (priority, next(self._order), kind, future)
+        bisect.insort(self.waiting, entry)
+        self.queued[kind] += 1
+        metrics.set_gauge("admission_waiting", len(self.waiting))
+        expiry = loop.call_later(self.max_wait, self._expire, entry)
+
+        start = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The client went away while waiting, give back the slot if it had already been granted
+            if not self._remove(entry) and future.done() and not future.cancelled() and future.exception() is None:
+                self.release(kind)
+            raise
+        finally:
+            expiry.cancel()
+            metrics.observe("admission_wait_seconds", time.perf_counter() - start, type=kind)
+
+    def release(self, kind):
+        if kind not in self.limits:
+            return
+        self.running[kind] -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def admit(self, kind):
+        """
+        Holds a slot for a request of type ``kind`` for the duration of the block
+
+        :raise Rejected: if the request is not admitted
+        """
+        await self.acquire(kind)
+        try:
+            yield
+        finally:
+            self.release(kind)
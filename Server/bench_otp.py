@@ -0,0 +1,74 @@
+"""
+Throughput benchmark for issuing one time passwords.
+
+Compares issuing codes one at a time the way the CLI used to, deleting expired codes from the whole table before every
+insert, with issuing them one at a time and in bulk with ``one_time_password``. Runs against the database in
+``config.database_info`` and removes all codes it issued afterwards. The old path also deletes expired codes, so it
+should not be pointed at a database with codes that matter.
+
+Usage: ``python bench_otp.py [--count 10000] [--single 500]``
+"""
+import argparse
+import datetime
+import time
+
+import config
+import one_time_password
+from cli import create_server_connection
+
+
+def old_generate_otp(connection):
+    """
+    Issues one code the way the CLI did before codes could be issued in bulk
+    """
+    cursor = connection.cursor()
+    password = one_time_password.random_otp()
+    time_added = datetime.datetime.now()
+    opt_expire = datetime.datetime.now() - datetime.timedelta(minutes=5)
+    cursor.execute("DELETE FROM coronomo.one_time_password WHERE time_added < %s", (opt_expire,))
+    cursor.execute("INSERT INTO coronomo.one_time_password (password, time_added) VALUES (%s, %s)",
+                   (password, time_added))
+    connection.commit()
+    cursor.close()
+    return password
+
+
+def bench(label, count, issue):
+    start = time.perf_counter()
+    issued = issue()
+    elapsed = time.perf_counter() - start
+    print(f"{label:>24}: {count:>7} codes in {elapsed:8.3f} s, {count / elapsed:10.0f} codes/s")
+    return issued
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=10000, help="codes to issue in bulk")
+    parser.add_argument("--single", type=int, default=500, help="codes to issue one at a time")
+    args = parser.parse_args()
+
+    host, user, password = config.database_info()
+    connection = create_server_connection(host, user, password)
+
+    codes = []
+    codes += bench("one at a time (old)", args.single,
+                   lambda: [old_generate_otp(connection) for _ in range(args.single)])
+    codes += bench("one at a time", args.single,
+                   lambda: [one_time_password.generate_otp(connection) for _ in range(args.single)])
+    codes += bench("bulk", args.count, lambda: one_time_password.generate_otps(connection, args.count))
+
+    assert len(set(codes)) == len(codes), "duplicate codes were issued"
+
+    # Remove the codes issued by the benchmark
+    cursor = connection.cursor()
+    for start in range(0, len(codes), one_time_password.CHUNK_SIZE):
+        chunk = codes[start:start + one_time_password.CHUNK_SIZE]
+        query = "DELETE FROM coronomo.one_time_password WHERE password IN ({})".format(", ".join(["%s"] * len(chunk)))
+        cursor.execute(query, chunk)
+    connection.commit()
+    cursor.close()
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
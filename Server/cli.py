@@ -1,9 +1,6 @@
-import string
-import secrets
-import datetime
 import mysql.connector
 from mysql.connector import Error
-import time
+import one_time_password
 
 
 def create_server_connection(host_name, user_name, user_password):
@@ -22,37 +19,43 @@ def create_server_connection(host_name, user_name, user_password):
 
 
 def generate_otp(connection):
-    cursor = connection.cursor()
-    password = ''.join(secrets.choice(string.digits) for i in range(8))
-    time_added = datetime.datetime.now()
-    try:
-        opt_expire = datetime.datetime.now() - datetime.timedelta(minutes=5)
-        query = "DELETE FROM coronomo.one_time_password WHERE time_added < %s"
-        cursor.execute(query, (opt_expire,))
-
-        cursor = connection.cursor()
-        query = "INSERT INTO coronomo.one_time_password (password, time_added) VALUES (%s, %s)"
-        cursor.execute(query, (password, time_added))
-        connection.commit()
-        cursor.close()
-
-        return password
+    return one_time_password.generate_otp(connection)
 
-    except Error as err:
-        print(f"Error: '{err}'")
 
+def read_count():
+    # Asks again until a positive whole number is entered
+    while True:
+        try:
+            count = int(input("How many keys? "))
+        except ValueError:
+            print("Please enter a whole number")
+            continue
+        if count > 0:
+            return count
+        print("Please enter a number greater than 0")
 
 
 def main():
     connection = create_server_connection("172.17.0.2", "root", "sql_password")
-    received = input("Press 'g' to generate key ")
+    prompt = "Press 'g' to generate key, 'b' to generate a batch of keys, 's' to remove expired keys "
+    received = input(prompt)
 
     while(received != ""):
 
         if(received == "g"):
             generate = generate_otp(connection)
             print(generate)
+        elif(received == "b"):
+            count = read_count()
+            generate = one_time_password.generate_otps(connection, count)
+            if generate is not None:
+                print("\n".join(generate))
+        elif(received == "s"):
+            deleted = one_time_password.sweep_expired_otps(connection)
+            print(f"Removed {deleted} expired keys")
         received = "null"
-        received = input("Press 'g' to generate key ")
+        received = input(prompt)
+
 
-main()
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import os
+
 def database_info():
     host = "172.17.0.2"
     user = "root"
@@ -8,3 +10,64 @@ def websocket_info():
     host = "131.236.131.243"
     port = 8765
     return(host, port)
+
+def metrics_info():
+    # Each worker serves its metrics on port + the worker's index
+    host = "127.0.0.1"
+    port = 8766
+    return(host, port)
+
+def logging_info():
+    # One of DEBUG, INFO, WARNING, ERROR. Logs are written as key=value fields, and each request is logged at DEBUG by
+    # the coronomo.access logger.
+    level = "INFO"
+    return level
+
+def profiler_info():
+    # Seconds between stack samples, or None to disable the sampling profiler
+    interval = None
+    return interval
+
+def worker_info():
+    # Number of worker processes sharing the websocket port, and where the shared diagnosis key snapshot is kept
+    workers = os.cpu_count() or 1
+    snapshot_path = "/dev/shm/coronomo_diagnosis_keys"
+    return (workers, snapshot_path)
+
+def snapshot_info():
+    # Seconds a worker waits after inserting diagnosis keys before publishing them, so that uploads arriving together
+    # are published by one snapshot rebuild
+    rebuild_delay = 2
+    return rebuild_delay
+
+def admission_info():
+    # Concurrent requests allowed per message type, how many requests may wait to start and for how many seconds
+    limits = {"refresh": 64, "upload": 4}
+    max_waiting = 256
+    max_wait = 2
+    return (limits, max_waiting, max_wait)
+
+def rate_limit_info():
+    # Upload attempts allowed per IP address per second, and in a single burst, counted across all workers
+    rate = 1 / 60
+    burst = 5
+    return (rate, burst)
+
+def otp_info():
+    # Unix socket on which the first worker issues one time passwords, only reachable by the server's user, e.g.
+    # curl --unix-socket /dev/shm/coronomo_otp.sock -X POST "http://localhost/otp?count=100"
+    socket_path = "/dev/shm/coronomo_otp.sock"
+    return socket_path
+
+def region_info():
+    # Region given to diagnosis keys uploaded by clients that do not send one
+    default_region = "AU-SA"
+    return default_region
+
+def session_info():
+    # Seconds between keepalive pings on persistent connections, seconds to wait for the pong, and how often each
+    # worker checks for diagnosis keys published by other workers
+    ping_interval = 20
+    ping_timeout = 20
+    push_poll_interval = 1
+    return (ping_interval, ping_timeout, push_poll_interval)
@@ -5,7 +5,8 @@ CREATE TABLE one_time_password
 (
   time_added   DATETIME NOT NULL,
   password     VARCHAR(8) NOT NULL,
-  PRIMARY KEY(password)
+  PRIMARY KEY(password),
+  INDEX(time_added)
 );
 
 # Key received from health official
@@ -14,5 +15,7 @@ CREATE TABLE diagnosis_keys
   diag_id INT AUTO_INCREMENT NOT NULL,
   temp_exposure_key BLOB NOT NULL,
   en_interval_num   INT NOT NULL,
-  PRIMARY KEY(diag_id)
+  region            VARCHAR(8) NOT NULL,
+  PRIMARY KEY(diag_id),
+  INDEX(region, en_interval_num)
 );
@@ -0,0 +1,42 @@
+"""
+Structured log output for the server.
+
+Every record is written as one line of ``key=value`` pairs (logfmt), starting with the time, level, logger and
+message. Values passed to a logging call with ``extra``, e.g. ``log.info("Request", extra={"type": "refresh"})``,
+become fields of their own, so logs can be filtered by message type, peer, duration and so on without parsing prose.
+"""
+import logging
+
+# Attributes every log record has. Anything else on a record was passed with ``extra`` and is written as a field.
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def _quote(value):
+    text = str(value)
+    if text and not any(character in text for character in ' "=\\\n'):
+        return text
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+
+class KeyValueFormatter(logging.Formatter):
+    default_time_format = "%Y-%m-%dT%H:%M:%S"
+    default_msec_format = "%s.%03d"
+
+    def format(self, record):
+        fields = [("time", self.formatTime(record)), ("level", record.levelname), ("logger", record.name),
+                  ("msg", record.getMessage())]
+        fields += [(key, value) for key, value in vars(record).items() if key not in _STANDARD_ATTRIBUTES]
+        if record.exc_info:
+            fields.append(("exc", self.formatException(record.exc_info)))
+        return " ".join(f"{key}={_quote(value)}" for key, value in fields)
+
+
+def configure(level):
+    """
+    Sends log records of at least ``level`` to standard error in the logfmt format. The ``websockets`` library logs
+    every connection opened and closed at INFO, so only its warnings are written.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(KeyValueFormatter())
+    logging.basicConfig(level=level, handlers=[handler])
+    logging.getLogger("websockets").setLevel(logging.WARNING)
@@ -0,0 +1,257 @@
+"""
+Built-in instrumentation for the websocket server.
+
+Keeps counters, gauges and histograms in process memory and renders them in the Prometheus text format, served from a
+small read-only HTTP endpoint bound to the local machine. An optional sampling profiler records collapsed stacks of
+the event loop thread, which can be fed straight into a flame graph tool. The same minimal HTTP server also serves
+endpoints that change state, but only on a Unix socket, see ``serve_unix``.
+"""
+import asyncio
+import bisect
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlsplit
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+log = logging.getLogger("coronomo.metrics")
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_gauges = defaultdict(int)
+_histograms = {}
+_profiler = None
+
+
+class Histogram:
+    """
+    A cumulative histogram with fixed upper bounds, as used by Prometheus
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """
+    Increments a counter
+
+    :param name: name of the counter
+    :param value: amount to add
+    :param labels: labels distinguishing this series, e.g. ``type="refresh"``
+    """
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def add_gauge(name, value, **labels):
+    """
+    Adds ``value`` (which may be negative) to a gauge, e.g. the number of open connections
+    """
+    with _lock:
+        _gauges[_key(name, labels)] += value
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """
+    Records a single observation in a histogram
+
+    :param name: name of the histogram
+    :param value: observed value, in seconds for latencies or bytes for sizes
+    :param buckets: upper bounds of the buckets, only used when the histogram is first created
+    :param labels: labels distinguishing this series
+    """
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+
+@contextmanager
+def timed(name, **labels):
+    """
+    Records how long the enclosed block takes in the ``name`` histogram. Can also be used as a function decorator.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def render():
+    """
+    Renders every metric in the Prometheus text exposition format
+
+    :return: the metrics as a string
+    """
+    lines = []
+    with _lock:
+        for (name, labels), value in sorted(_counters.items()):
+            lines.append(f"coronomo_{name}{_format_labels(labels)} {value}")
+        for (name, labels), value in sorted(_gauges.items()):
+            lines.append(f"coronomo_{name}{_format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(_histograms.items(), key=lambda item: item[0]):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f"coronomo_{name}_bucket{_format_labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"coronomo_{name}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"coronomo_{name}_count{_format_labels(labels)} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    A daemon thread that periodically samples the stack of another thread and counts identical stacks. Sampling
+    ``sys._current_frames`` costs a few microseconds per sample, so it can stay on under real load.
+    """
+    def __init__(self, interval, thread_id=None):
+        super().__init__(name="coronomo-profiler", daemon=True)
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.samples = defaultdict(int)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def render(self):
+        """
+        :return: the samples in collapsed stack format, one ``stack count`` line per distinct stack
+        """
+        samples = sorted(self.samples.items(), key=lambda item: item[1], reverse=True)
+        return "".join(f"{stack} {count}\n" for stack, count in samples)
+
+
+def start_profiler(interval):
+    """
+    Starts sampling the calling thread every ``interval`` seconds
+    """
+    global _profiler
+    _profiler = SamplingProfiler(interval)
+    _profiler.start()
+    log.info("Sampling profiler started", extra={"interval": interval})
+    return _profiler
+
+
+async def _metrics_route(method, query):
+    return render()
+
+
+async def _profile_route(method, query):
+    if _profiler is None:
+        raise LookupError("The profiler is not running")
+    return _profiler.render()
+
+
+async def _handle_http(reader, writer, routes, methods):
+    try:
+        request_line = await reader.readline()
+        # Drain the headers, the request body is never used
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = request_line.decode("latin-1").split()
+        method = parts[0] if parts else "GET"
+        url = urlsplit(parts[1] if len(parts) > 1 else "/")
+        path = url.path
+
+        if path not in routes:
+            status, body = "404 Not Found", "Not found\n"
+        elif method not in methods:
+            status, body = "405 Method Not Allowed", f"{method} is not allowed here\n"
+        else:
+            try:
+                status, body = "200 OK", await routes[path](method, parse_qs(url.query))
+            except ValueError as err:
+                status, body = "400 Bad Request", f"{err}\n"
+            except LookupError as err:
+                status, body = "404 Not Found", f"{err}\n"
+            except Exception as err:
+                log.exception("Error handling HTTP request", extra={"path": path})
+                status, body = "500 Internal Server Error", f"{err}\n"
+
+        body = body.encode("UTF-8")
+        writer.write(f"HTTP/1.0 {status}\r\n"
+                     f"Content-Type: text/plain; version=0.0.4\r\n"
+                     f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+def serve(host, port):
+    """
+    Creates a plain, read-only HTTP server exposing ``/metrics`` and, if the profiler is running, ``/profile``
+
+    :param host: interface to bind to, this should normally be the loopback interface
+    :param port: port to listen on
+    :return: coroutine that starts the server. The port is bound with ``SO_REUSEPORT``, so a replacement worker can
+        bind it while the worker it replaces is still shutting down.
+    """
+    routes = {"/metrics": _metrics_route, "/profile": _profile_route}
+    log.info("Metrics available", extra={"url": f"http://{host}:{port}/metrics"})
+    return asyncio.start_server(functools.partial(_handle_http, routes=routes, methods=("GET", "HEAD")), host, port,
+                                reuse_port=True)
+
+
+async def serve_unix(path, routes):
+    """
+    Creates a plain HTTP server on a Unix socket that only its owner may connect to, for endpoints that change state
+    and so must not be reachable by every local process
+
+    :param path: path of the socket, an existing socket at that path is replaced
+    :param routes: mapping of a path to a coroutine function that is called with the request method and the parsed
+        query string and returns the response text. It may raise ValueError to reply with 400 Bad Request.
+    :return: the server
+    """
+    # Create the socket without group or other permissions, rather than changing them after it is already reachable
+    umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(
+            functools.partial(_handle_http, routes=routes, methods=("GET", "POST")), path)
+    finally:
+        os.umask(umask)
+    log.info("Local endpoints available", extra={"socket": path, "paths": ",".join(routes)})
+    return server
@@ -0,0 +1,134 @@
+"""
+Issuing, checking and expiring one time passwords.
+
+Codes are issued in bulk: any number of codes is inserted in one transaction with multi-row inserts. The primary key
+on ``password`` guarantees that a code is never live twice, and a chunk that collides with an existing code is rolled
+back to its savepoint and retried with fresh codes. Expired codes are no longer removed on every call, see
+``sweep_expired_otps``.
+"""
+import datetime
+import logging
+import secrets
+
+from mysql.connector import Error, errorcode
+
+OTP_LENGTH = 8
+OTP_LIFETIME = datetime.timedelta(minutes=15)
+# Rows per INSERT statement
+CHUNK_SIZE = 500
+# Attempts per chunk before giving up, each collision is roughly (live codes * CHUNK_SIZE / 10^8) likely
+MAX_ATTEMPTS = 10
+# Seconds between sweeps of expired codes by the server
+SWEEP_INTERVAL = 60
+
+log = logging.getLogger("coronomo.one_time_password")
+
+
+def random_otp():
+    return f"{secrets.randbelow(10 ** OTP_LENGTH):0{OTP_LENGTH}d}"
+
+
+def _unique_codes(count, exclude):
+    codes = set()
+    while len(codes) < count:
+        code = random_otp()
+        if code not in exclude:
+            codes.add(code)
+    return list(codes)
+
+
+def generate_otps(connection, count):
+    """
+    Issues ``count`` unique one time passwords in a single transaction
+
+    :param connection: MySQL connection
+    :param count: number of codes to issue
+    :return: list of the issued codes, or None if they could not be issued
+    """
+    cursor = connection.cursor()
+    time_added = datetime.datetime.now()
+    issued = []
+
+    try:
+        while len(issued) < count:
+            needed = min(CHUNK_SIZE, count - len(issued))
+            for attempt in range(MAX_ATTEMPTS):
+                codes = _unique_codes(needed, set(issued))
+                query = "INSERT INTO coronomo.one_time_password (password, time_added) VALUES " + \
+                        ", ".join(["(%s, %s)"] * needed)
+                params = [value for code in codes for value in (code, time_added)]
+
+                cursor.execute("SAVEPOINT otp_chunk")
+                try:
+                    cursor.execute(query, params)
+                except Error as err:
+                    if err.errno != errorcode.ER_DUP_ENTRY:
+                        raise
+                    cursor.execute("ROLLBACK TO SAVEPOINT otp_chunk")
+                    log.debug("One time password collision, retrying chunk", extra={"attempt": attempt + 1})
+                    continue
+                issued.extend(codes)
+                break
+            else:
+                raise Error(msg=f"Could not issue unique one time passwords after {MAX_ATTEMPTS} attempts")
+
+        connection.commit()
+        cursor.close()
+        return issued
+
+    except Error as err:
+        connection.rollback()
+        log.error("Database error", extra={"error": err})
+
+
+def generate_otp(connection):
+    """
+    Issues a single one time password
+
+    :return: the code, or None if it could not be issued
+    """
+    codes = generate_otps(connection, 1)
+    return codes[0] if codes else None
+
+
+def check_otp(connection, otp):
+    """
+    Uses up a one time password. Deleting the code is the check, so a code can only ever be used once even when it
+    is submitted twice at the same time.
+
+    :return: True if the code was live, False if not, None on a database error
+    """
+    cursor = connection.cursor()
+
+    try:
+        opt_expire = datetime.datetime.now() - OTP_LIFETIME
+        query = "DELETE FROM coronomo.one_time_password WHERE password = %s AND time_added >= %s"
+        cursor.execute(query, (otp, opt_expire))
+        valid = cursor.rowcount > 0
+        connection.commit()
+        cursor.close()
+        return valid
+
+    except Error as err:
+        log.error("Database error", extra={"error": err})
+
+
+def sweep_expired_otps(connection):
+    """
+    Deletes all expired one time passwords
+
+    :return: number of codes deleted, or None on a database error
+    """
+    cursor = connection.cursor()
+
+    try:
+        opt_expire = datetime.datetime.now() - OTP_LIFETIME
+        query = "DELETE FROM coronomo.one_time_password WHERE time_added < %s"
+        cursor.execute(query, (opt_expire,))
+        deleted = cursor.rowcount
+        connection.commit()
+        cursor.close()
+        return deleted
+
+    except Error as err:
+        log.error("Database error", extra={"error": err})
@@ -1,13 +1,48 @@
 import asyncio
 import websockets
-import datetime
 import mysql.connector
+import mysql.connector.pooling
 from mysql.connector import Error
+import os
 import pickle
+import re
+import signal
+import logging
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import admission
 import config
+import keyset
+import logfmt
+import metrics
+import one_time_password
+import snapshot
+import workers
 
 mysql_host, mysql_user, mysql_password = config.database_info()
 socket_host, socket_port = config.websocket_info()
+metrics_host, metrics_port = config.metrics_info()
+worker_count, snapshot_path = config.worker_info()
+admission_limits, admission_max_waiting, admission_max_wait = config.admission_info()
+upload_rate, upload_burst = config.rate_limit_info()
+rebuild_delay = config.snapshot_info()
+ping_interval, ping_timeout, push_poll_interval = config.session_info()
+default_region = config.region_info()
+otp_socket_path = config.otp_info()
+
+TEK_ROLLING_PERIOD = 144
+# Most regions and days a single refresh may ask for. Clients keep 14 days of contacts and ask for the days either
+# side of each day they saw someone, so up to 17 days.
+MAX_REGIONS = 16
+MAX_DAYS = 17
+
+# Seconds of a worker's shutdown grace period kept for publishing the keys uploaded while it drains
+SHUTDOWN_PUBLISH_TIME = 5
+
+log = logging.getLogger("coronomo.server")
+# One line per request at DEBUG, with its type, peer, duration and outcome as fields
+access_log = logging.getLogger("coronomo.access")
 
 
 def create_server_connection(host_name, user_name, user_password):
@@ -18,124 +53,634 @@ def create_server_connection(host_name, user_name, user_password):
             user=user_name,
             passwd=user_password
         )
-        print("MySQL Database connection successful")
+        log.info("MySQL Database connection successful")
     except Error as err:
-        print(f"Error: '{err}'")
+        log.error("Database error", extra={"error": err})
 
     return connection
 
 
-def get_diagnosis_keys(connection):
-    cursor = connection.cursor()
+def create_connection_pool(host_name, user_name, user_password, size):
+    pool = None
+    try:
+        pool = mysql.connector.pooling.MySQLConnectionPool(
+            pool_name="coronomo",
+            pool_size=size,
+            host=host_name,
+            user=user_name,
+            passwd=user_password
+        )
+        log.info("MySQL Database connection pool created", extra={"connections": size})
+    except Error as err:
+        log.error("Database error", extra={"error": err})
 
-    diagnosis_keys = []
+    return pool
 
-    try:
-        query = "SELECT temp_exposure_key, en_interval_num FROM coronomo.diagnosis_keys"
 
+@metrics.timed("db_query_seconds", query="get_diagnosis_keys")
+def get_diagnosis_keys(connection, shards=None):
+    """
+    Reads diagnosis keys, grouped by region and day
 
-        cursor.execute(query)
+    :param shards: ``(region, day)`` of the shards to read, or None to read all diagnosis keys
+    :return: dictionary mapping each ``(region, day)`` to a ``DiagnosisKeySet``, or None on error
+    """
+    diagnosis_keys = defaultdict(keyset.DiagnosisKeySet)
+    if shards is not None and not shards:
+        return diagnosis_keys
 
-        for (temp_exposure_key, en_interval_num) in cursor:
-            diagnosis_keys.append((temp_exposure_key, en_interval_num))
+    cursor = connection.cursor()
+
+    try:
+        query = "SELECT temp_exposure_key, en_interval_num, region FROM coronomo.diagnosis_keys"
+        params = []
+        if shards is not None:
+            query += " WHERE " + " OR ".join(["(region = %s AND en_interval_num BETWEEN %s AND %s)"] * len(shards))
+            for region, day in shards:
+                params += [region, day * TEK_ROLLING_PERIOD, (day + 1) * TEK_ROLLING_PERIOD - 1]
 
-        print("Selection successful")
+        cursor.execute(query, params)
+
+        for (temp_exposure_key, en_interval_num, region) in cursor:
+            if not valid_key(temp_exposure_key, en_interval_num):
+                # Stored before uploads were checked, a bad row must not stop every other key being published
+                metrics.inc("malformed_keys_total")
+                log.warning("Skipping malformed diagnosis key", extra={"region": region, "enin": en_interval_num})
+                continue
+            diagnosis_keys[(region, en_interval_num // TEK_ROLLING_PERIOD)].append(temp_exposure_key, en_interval_num)
+
+        log.debug("Selected diagnosis keys", extra={"keys": sum(len(keys) for keys in diagnosis_keys.values())})
 
     except Error as err:
-        print(f"Error: '{err}'")
+        metrics.inc("db_errors_total", query="get_diagnosis_keys")
+        log.error("Database error", extra={"error": err})
+        return None
 
     return diagnosis_keys
 
 
-def check_otp(connection, otp):
-    cursor = connection.cursor(buffered=True)
+@metrics.timed("db_query_seconds", query="get_new_shards")
+def get_new_shards(connection, after):
+    """
+    Finds the shards that diagnosis keys have been stored in since ``after``
 
+    :param after: ``diag_id`` of the last key already published
+    :return: set of the ``(region, day)`` of the shards and the highest ``diag_id`` stored, or None on error
+    """
+    cursor = connection.cursor()
 
     try:
-        opt_expire = datetime.datetime.now() - datetime.timedelta(minutes=15)
-        query = "DELETE FROM coronomo.one_time_password WHERE time_added < %s"
-        cursor.execute(query, (opt_expire,))
-        cursor.close()
+        query = "SELECT region, en_interval_num DIV %s, MAX(diag_id) FROM coronomo.diagnosis_keys " \
+                "WHERE diag_id > %s GROUP BY 1, 2"
+        cursor.execute(query, (TEK_ROLLING_PERIOD, after))
 
-        cursor = connection.cursor(buffered=True)
-        query = "SELECT * FROM coronomo.one_time_password WHERE password = %s"
-        cursor.execute(query, (otp,))
+        shards, last_id = set(), after
+        for region, day, max_id in cursor:
+            shards.add((region, int(day)))
+            last_id = max(last_id, max_id)
 
-        print(cursor.fetchall())
+    except Error as err:
+        metrics.inc("db_errors_total", query="get_new_shards")
+        log.error("Database error", extra={"error": err})
+        return None
 
-        if cursor.rowcount > 0:
-            query = "DELETE FROM coronomo.one_time_password WHERE password = %s"
-            cursor.execute(query, (otp,))
-            connection.commit()
-            return True
+    return shards, last_id
 
-        else:
-            connection.commit()        
-            return False
-            
 
-    except Error as err:
-        print(f"Error: '{err}'")
+@metrics.timed("db_query_seconds", query="check_otp")
+def check_otp(connection, otp):
+    valid = one_time_password.check_otp(connection, otp)
+    if valid is None:
+        metrics.inc("db_errors_total", query="check_otp")
+    return valid
 
 
-def insert_diagnosis_keys(connection, diagnosis_keys):
+@metrics.timed("db_query_seconds", query="insert_diagnosis_keys")
+def insert_diagnosis_keys(connection, diagnosis_keys, region):
     cursor = connection.cursor()
 
     try:
         
-        for i in diagnosis_keys:
-            print(i)
-
-            query = "INSERT INTO coronomo.diagnosis_keys(temp_exposure_key, en_interval_num) VALUES (_binary %s, %s)"
-            cursor.execute(query, i)
+        for tek, enin in diagnosis_keys:
+            query = "INSERT INTO coronomo.diagnosis_keys(temp_exposure_key, en_interval_num, region) " \
+                    "VALUES (_binary %s, %s, %s)"
+            cursor.execute(query, (tek, enin, region))
 
         connection.commit()
 
         return True
 
     except Error as err:
-        print(f"Error: '{err}'")
+        metrics.inc("db_errors_total", query="insert_diagnosis_keys")
+        log.error("Database error", extra={"error": err})
+
+
+def message_type(load):
+    if load == "refresh":
+        return load
+    if isinstance(load, tuple) and load and load[0] == "refresh":
+        return "refresh"
+    return "upload"
+
+
+def valid_region(region):
+    return isinstance(region, str) and re.fullmatch(r"[A-Za-z0-9-]{1,8}", region) is not None
+
+
+def valid_key(tek, enin):
+    """
+    :return: True if ``tek`` is a 16 byte Temporary Exposure Key and ``enin`` an EN Interval Number that fits the
+        32 bits of a key set
+    """
+    return (isinstance(tek, (bytes, bytearray)) and len(tek) == keyset.TEK_LENGTH and type(enin) is int
+            and 0 <= enin <= 0xFFFFFFFF)
+
+
+def upload_request(load, default_region):
+    """
+    Unpacks and checks an upload, ``(otp, diagnosis_keys, region)``. Clients that predate regions send
+    ``(otp, diagnosis_keys)``, which are given ``default_region``.
+
+    :return: the one time password, the diagnosis keys and the region
+    :raise ValueError: if the upload is malformed, has no keys, or a key is not a 16 byte TEK with a 32 bit EN Interval
+        Number
+    """
+    if not isinstance(load, tuple) or len(load) not in (2, 3):
+        raise ValueError("An upload must be (otp, diagnosis_keys, region)")
+    otp, diagnosis_keys, region = load if len(load) == 3 else load + (default_region,)
+
+    if not isinstance(diagnosis_keys, (list, tuple)) or not diagnosis_keys:
+        raise ValueError("Diagnosis keys must be a list of at least one key")
+    for key in diagnosis_keys:
+        if not isinstance(key, (list, tuple)) or len(key) != 2 or not valid_key(*key):
+            raise ValueError(f"Each diagnosis key must be a {keyset.TEK_LENGTH} byte Temporary Exposure Key and an "
+                             f"EN Interval Number from 0 to 2**32 - 1")
+    return otp, diagnosis_keys, region
+
+
+def requested_shards(load):
+    """
+    Works out which shards of the snapshot a refresh asks for. A plain ``"refresh"`` asks for every key, while
+    ``("refresh", regions, days)`` asks for the keys of the given regions from the given days, where a day is an EN
+    Interval Number divided by 144.
+
+    :return: list of shard keys
+    :raise ValueError: if the refresh is malformed, asks for too many regions or days, or a day is not an integer
+    """
+    if load == "refresh":
+        return [None]
+
+    if len(load) != 3:
+        raise ValueError("A refresh must be (\"refresh\", regions, days)")
+    _, regions, days = load
+    if not isinstance(regions, (list, tuple, set)) or not isinstance(days, (list, tuple, set)):
+        raise ValueError("Regions and days must be lists")
+    if len(regions) > MAX_REGIONS or len(days) > MAX_DAYS:
+        raise ValueError(f"A refresh may ask for at most {MAX_REGIONS} regions and {MAX_DAYS} days")
+    if any(type(day) is not int for day in days):
+        raise ValueError("Days must be integers")
+    regions = [region for region in regions if valid_region(region)]
+    return [(region, day) for region in regions for day in days]
+
+
+def session_load(message, default_region):
+    """
+    Converts a session request into the equivalent single request message. Session requests are dictionaries with an
+    ``id`` that is echoed in the reply and a ``type``:
+
+    - ``{"type": "subscribe", "regions": [...], "version": ...}`` asks for ``new_batch`` messages for the given
+      regions, and for the shards changed since the snapshot version the client last saw, if it has seen one
+    - ``{"type": "refresh", "regions": [...], "days": [...]}``
+    - ``{"type": "upload", "otp": ..., "keys": [...], "region": ...}``
+
+    :return: the single request message, or None if the request is not understood
+    """
+    kind = message.get("type")
+    if kind == "refresh":
+        return ("refresh", message.get("regions", []), message.get("days", []))
+    if kind == "upload":
+        return (message.get("otp"), message.get("keys", []), message.get("region", default_region))
+    return None
+
+
+def build_snapshot(connection, current=None, dirty=None):
+    """
+    Serializes the diagnosis keys into one shard per region and day, plus one shard of all keys. The shards are
+    serialized key sets, except the shard of all keys, which is only sent to clients that predate key sets and so is a
+    pickled list.
+
+    :param current: the snapshot being replaced, or None
+    :param dirty: ``(region, day)`` of the shards with new diagnosis keys, which are read from the database along with
+        the shards of any keys stored after the last key in ``current``. The other shards are copied from ``current``.
+        If None, or there is no current snapshot, every shard is read.
+    :return: the serialized shards and the highest ``diag_id`` among their keys, or None on error
+    """
+    if connection is None:
+        return None
+    if current is None:
+        dirty = None
+
+    # Read in the same transaction as the keys, so no key stored in between is counted as published
+    new = get_new_shards(connection, 0 if current is None else current.last_id)
+    if new is None:
+        return None
+    new_shards, last_id = new
+    if dirty is not None:
+        dirty = set(dirty) | new_shards
+
+    shards = get_diagnosis_keys(connection, dirty)
+    if shards is None:
+        return None
+
+    serialized = {}
+    if dirty is not None:
+        serialized = {key: current.shard(key) for key in current.index if key is not None and key not in shards}
+    for key, keys in shards.items():
+        serialized[key] = keys.deduplicate().to_bytes()
+
+    all_keys = keyset.DiagnosisKeySet()
+    for shard in serialized.values():
+        all_keys.extend(keyset.DiagnosisKeySet.from_bytes(shard))
+    serialized[None] = all_keys.to_pickled_list()
+    return serialized, last_id
+
+
+def upload(pool, otp, diagnosis_keys, region):
+    """
+    Checks the one time password and inserts the diagnosis keys. Runs in a thread of the upload executor with its own
+    pooled connection, so the event loop keeps serving refreshes meanwhile. The keys are published by a later
+    ``rebuild_snapshot``.
+
+    :return: True if the diagnosis keys were inserted
+    """
+    connection = pool.get_connection()
+    try:
+        insert_successful = False
 
+        if(check_otp(connection, otp)):
+            log.info("Valid one time password, inserting diagnosis keys",
+                     extra={"keys": len(diagnosis_keys), "region": region})
+            insert_successful = insert_diagnosis_keys(connection, diagnosis_keys, region)
 
-def main():
-    connection = create_server_connection(mysql_host, mysql_user, mysql_password)
+        return insert_successful
+    finally:
+        connection.close()
 
-    async def server(websocket, path):
-    
-        incoming = await websocket.recv()
 
-        load = pickle.loads(incoming)
+def rebuild_snapshot(pool, dirty=None):
+    """
+    Publishes a new snapshot, reading only the shards in ``dirty`` from the database. Runs in a thread of the upload
+    executor, outside any request's admission slot.
 
-        if(load == "refresh"):
-            send_back = pickle.dumps(get_diagnosis_keys(connection))
-        else:
-            otp,diagnosis_keys = load
-        
-            insert_successful = False
+    :param dirty: ``(region, day)`` of the shards with new diagnosis keys, or None to read every shard
+    :return: True if a new snapshot was published
+    """
+    connection = pool.get_connection()
+    try:
+        return snapshot.rebuild(snapshot_path, lambda current: build_snapshot(connection, current, dirty))
+    finally:
+        connection.close()
 
-            print(otp)
-            print(diagnosis_keys)
 
-            if(check_otp(connection, otp)):
-                print("Valid")
-                insert_successful = insert_diagnosis_keys(connection, diagnosis_keys)
-            
-            if(insert_successful):
-                send_back = "Insertion successful"
-            else:
-                send_back = "Insertion not successful"
+def issue_otps(pool, count):
+    connection = pool.get_connection()
+    try:
+        with metrics.timed("db_query_seconds", query="generate_otps"):
+            codes = one_time_password.generate_otps(connection, count)
+        if codes is None:
+            metrics.inc("db_errors_total", query="generate_otps")
+        else:
+            metrics.inc("otps_issued_total", len(codes))
+        return codes
+    finally:
+        connection.close()
 
-        
-        await websocket.send(send_back)
 
+def sweep_otps(pool):
+    connection = pool.get_connection()
+    try:
+        with metrics.timed("db_query_seconds", query="sweep_expired_otps"):
+            deleted = one_time_password.sweep_expired_otps(connection)
+        if deleted:
+            log.info("Swept expired one time passwords", extra={"deleted": deleted})
+    finally:
+        connection.close()
+
+
+def serve(index):
+    """
+    Runs one websocket server worker. Refresh requests are answered from the shared diagnosis key snapshot, which is
+    rebuilt by whichever worker inserts new diagnosis keys, ``rebuild_delay`` seconds after its first upload. Requests
+    are subject to admission control, see ``admission``.
+
+    :param index: index of the worker, used to give each worker its own metrics port
+    """
+    # One connection and thread more than the concurrent uploads, for snapshot rebuilds
+    upload_limit = admission_limits["upload"]
+    pool = create_connection_pool(mysql_host, mysql_user, mysql_password, upload_limit + 1)
+    executor = ThreadPoolExecutor(max_workers=upload_limit + 1, thread_name_prefix="coronomo-upload")
+    admission_control = admission.Admission(admission_limits, admission_max_waiting, admission_max_wait)
+    upload_bucket = admission.SharedTokenBucket(snapshot_path + ".upload_buckets", upload_rate, upload_burst)
+    keys_snapshot = snapshot.Snapshot(snapshot_path)
+    active = set()
+    # Open sessions and the regions each is subscribed to, None for all regions
+    sessions = {}
+    # Shards this worker has inserted diagnosis keys into since its last rebuild
+    dirty_shards = set()
+    keys_inserted = asyncio.Event()
+
+    if not os.path.exists(snapshot_path):
+        rebuild_snapshot(pool)
+
+    if os.path.exists(snapshot_path):
+        keys_snapshot.refresh()
+    pushed_version = keys_snapshot.version or 0
+
+    async def respond(websocket, load, size):
+        """
+        Answers a single request
+
+        :param load: the unpickled request
+        :param size: size of the request in bytes
+        :return: the reply
+        """
+        kind = message_type(load)
+        metrics.observe("request_bytes", size, metrics.SIZE_BUCKETS, type=kind)
+        start = time.perf_counter()
+        outcome = "ok"
+
+        try:
+            if(kind == "upload"):
+                upload_bucket.take(websocket.remote_address[0])
+                # Checked before the one time password, so a malformed key can never be stored
+                otp, diagnosis_keys, region = upload_request(load, default_region)
+            elif(kind == "refresh"):
+                # Checked before admission, so invalid refreshes never hold a slot
+                shard_keys = requested_shards(load)
+
+            async with admission_control.admit(kind):
+                with metrics.timed("request_seconds", type=kind):
+                    if(load == "refresh"):
+                        send_back = keys_snapshot.shard(None) or pickle.dumps([])
+                    elif(kind == "refresh"):
+                        shards = [keys_snapshot.shard(key) for key in shard_keys]
+                        send_back = pickle.dumps([shard for shard in shards if shard is not None])
+                    else:
+                        insert_successful = valid_region(region) and await loop.run_in_executor(
+                            executor, upload, pool, otp, diagnosis_keys, region)
+
+                        if(insert_successful):
+                            dirty_shards.update((region, enin // TEK_ROLLING_PERIOD) for _, enin in diagnosis_keys)
+                            keys_inserted.set()
+                            send_back = "Insertion successful"
+                        else:
+                            send_back = "Insertion not successful"
+
+        except admission.Rejected as rejection:
+            metrics.inc("admission_rejected_total", type=kind, reason=rejection.reason)
+            log.debug("Rejected request", extra={"type": kind, "peer": websocket.remote_address[0],
+                                                 "reason": rejection.reason, "retry_after": rejection.retry_after})
+            send_back = rejection.reply()
+            outcome = "rejected"
+
+        except ValueError as err:
+            metrics.inc("invalid_requests_total", type=kind)
+            send_back = f"Invalid request: {err}"
+            outcome = "invalid"
+
+        metrics.inc("requests_total", type=kind)
+        metrics.observe("response_bytes", len(send_back), metrics.SIZE_BUCKETS, type=kind)
+        access_log.debug("Request", extra={"type": kind, "peer": websocket.remote_address[0], "outcome": outcome,
+                                          "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+                                          "request_bytes": size, "response_bytes": len(send_back)})
+        return send_back
+
+    async def answer(websocket, message, size):
+        load = session_load(message, default_region)
+        if load is None:
+            reply = {"id": message.get("id"), "error": "Unknown request"}
+        else:
+            reply = {"id": message.get("id"), "reply": await respond(websocket, load, size)}
+        await websocket.send(pickle.dumps(reply))
+
+    def subscribed(regions, since):
+        """
+        Answers a subscribe with the version of the current snapshot, and the shards of ``regions`` that changed
+        after version ``since``, the last one the client saw. The shards are None if the client has not seen any
+        version, so it must refresh everything.
+        """
+        try:
+            keys_snapshot.refresh()
+        except OSError as err:
+            log.error("Could not read the diagnosis key snapshot", extra={"error": err})
+            return {"type": "subscribed", "version": None, "shards": None}
+
+        shards = None
+        if type(since) is int:
+            shards = [shard for shard in snapshot.changed_shards(keys_snapshot.index, since)
+                      if regions is None or shard[0] in regions]
+        return {"type": "subscribed", "version": keys_snapshot.version, "shards": shards}
+
+    async def session(websocket, message, size):
+        """
+        Serves a persistent session, see ``session_load``. Requests are answered concurrently and their replies
+        carry the request's ID. A subscribe is answered straight away, see ``subscribed``, and subscribed sessions are
+        then sent a ``new_batch`` message whenever new diagnosis keys are published for one of their regions.
+        """
+        metrics.inc("sessions_total")
+        metrics.add_gauge("sessions_active", 1)
+        sessions[websocket] = None
+        pending = set()
+        try:
+            while True:
+                if message.get("type") == "subscribe":
+                    regions = message.get("regions")
+                    sessions[websocket] = None if regions is None else set(regions)
+                    await websocket.send(pickle.dumps(subscribed(sessions[websocket], message.get("version"))))
+                else:
+                    task = loop.create_task(answer(websocket, message, size))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+
+                incoming = await websocket.recv()
+                message, size = pickle.loads(incoming), len(incoming)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            del sessions[websocket]
+            for task in pending:
+                task.cancel()
+            metrics.add_gauge("sessions_active", -1)
+
+    async def server(websocket, path):
+        metrics.inc("connections_total")
+        metrics.add_gauge("connections_active", 1)
+        active.add(websocket)
+        try:
+            incoming = await websocket.recv()
+
+            load = pickle.loads(incoming)
+            if isinstance(load, dict):
+                await session(websocket, load, len(incoming))
+            else:
+                # A single request on its own connection
+                await websocket.send(await respond(websocket, load, len(incoming)))
+        finally:
+            active.discard(websocket)
+            metrics.add_gauge("connections_active", -1)
+
+    async def push(websocket, message):
+        try:
+            await websocket.send(message)
+            metrics.inc("pushes_total")
+        except websockets.ConnectionClosed:
+            pass
+
+    def push_new_batches():
+        """
+        Tells subscribed sessions which shards have changed since the last time this worker looked at the snapshot.
+        Called right after this worker publishes new keys, and periodically to pick up keys published by other
+        workers.
+        """
+        nonlocal pushed_version
+        keys_snapshot.refresh()
+        if keys_snapshot.version is None or keys_snapshot.version == pushed_version:
+            return
+        changed = snapshot.changed_shards(keys_snapshot.index, pushed_version)
+        pushed_version = keys_snapshot.version
+        if not changed:
+            return
+
+        log.info("New diagnosis keys, notifying sessions", extra={"shards": len(changed), "sessions": len(sessions)})
+        for websocket, regions in list(sessions.items()):
+            shards = [shard for shard in changed if regions is None or shard[0] in regions]
+            if shards:
+                message = pickle.dumps({"type": "new_batch", "version": keys_snapshot.version, "shards": shards})
+                loop.create_task(push(websocket, message))
+
+    async def publish_dirty_shards():
+        nonlocal dirty_shards
+        shards, dirty_shards = dirty_shards, set()
+        try:
+            published = await loop.run_in_executor(executor, rebuild_snapshot, pool, shards)
+        except Exception:
+            log.exception("Could not rebuild the diagnosis key snapshot")
+            published = False
+
+        if published:
+            push_new_batches()
+        else:
+            # Try again after the next delay
+            dirty_shards |= shards
+            keys_inserted.set()
+
+    async def rebuild_when_dirty():
+        while True:
+            await keys_inserted.wait()
+            # Wait for the uploads that arrive meanwhile, so they are published together
+            await asyncio.sleep(rebuild_delay)
+            keys_inserted.clear()
+            await publish_dirty_shards()
+
+    async def watch_snapshot():
+        while True:
+            await asyncio.sleep(push_poll_interval)
+            try:
+                push_new_batches()
+            except OSError as err:
+                log.error("Could not read the diagnosis key snapshot", extra={"error": err})
+
+    async def issue_otps_route(method, query):
+        # Health provider systems on this machine can issue codes with POST /otp?count=N on the OTP socket
+        if method != "POST":
+            raise ValueError("Codes must be issued with POST")
+        count = int(query.get("count", ["1"])[0])
+        if not 0 < count <= 100000:
+            raise ValueError("count must be between 1 and 100000")
+        codes = await loop.run_in_executor(executor, issue_otps, pool, count)
+        if codes is None:
+            raise RuntimeError("Could not issue one time passwords")
+        return "".join(code + "\n" for code in codes)
+
+    async def sweep_otps_periodically():
+        while True:
+            await asyncio.sleep(one_time_password.SWEEP_INTERVAL)
+            try:
+                await loop.run_in_executor(executor, sweep_otps, pool)
+            except Exception:
+                log.exception("Could not sweep expired one time passwords")
+
+    async def shutdown(websocket_server):
+        # Stop accepting connections, then give open connections time to finish before closing them
+        log.info("Worker shutting down", extra={"worker": index})
+        websocket_server.server.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        if otp_server is not None:
+            otp_server.close()
+        deadline = time.monotonic() + workers.SHUTDOWN_GRACE - SHUTDOWN_PUBLISH_TIME
+        # Publish the keys uploaded since the last rebuild before draining, the supervisor kills workers that are still
+        # draining at the end of the grace period
+        rebuilder.cancel()
+        if dirty_shards:
+            await publish_dirty_shards()
+
+        # Sessions stay open indefinitely, so ask them to reconnect to another worker rather than waiting for them
+        for websocket in list(sessions):
+            loop.create_task(websocket.close(1001, "Server restarting"))
+        while active and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        websocket_server.close()
+        await websocket_server.wait_closed()
+        # And the keys of uploads that finished while draining. Any left unpublished are found by the next rebuild.
+        if dirty_shards:
+            await publish_dirty_shards()
+        loop.stop()
+
+    profiler_interval = config.profiler_info()
+    if profiler_interval:
+        metrics.start_profiler(profiler_interval)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    websocket_server = loop.run_until_complete(websockets.serve(server, port=socket_port, reuse_port=True,
+                                                                ping_interval=ping_interval, ping_timeout=ping_timeout))
+    try:
+        metrics_server = loop.run_until_complete(metrics.serve(metrics_host, metrics_port + index))
+    except OSError as err:
+        # Metrics are not worth failing the worker over
+        log.error("Could not start the metrics server", extra={"worker": index, "error": err})
+        metrics_server = None
+    otp_server = None
+    if index == 0:
+        try:
+            otp_server = loop.run_until_complete(metrics.serve_unix(otp_socket_path, {"/otp": issue_otps_route}))
+        except OSError as err:
+            log.error("Could not start the one time password endpoint", extra={"socket": otp_socket_path, "error": err})
+        loop.create_task(sweep_otps_periodically())
+    loop.create_task(watch_snapshot())
+    rebuilder = loop.create_task(rebuild_when_dirty())
+    loop.add_signal_handler(signal.SIGTERM, lambda: loop.create_task(shutdown(websocket_server)))
+    log.info("Server started", extra={"worker": index, "pid": os.getpid()})
+
+    loop.run_forever()
 
 
-    start_server = websockets.serve(server, port=socket_port)
-    print("Server started")
+def main():
+    logfmt.configure(config.logging_info())
 
-    asyncio.get_event_loop().run_until_complete(start_server)
-    asyncio.get_event_loop().run_forever()
+    # Build the snapshot once before forking so that the workers do not all start by building it
+    connection = create_server_connection(mysql_host, mysql_user, mysql_password)
+    snapshot.rebuild(snapshot_path, lambda current: build_snapshot(connection))
+    if connection is not None:
+        connection.close()
 
-main()
+    if worker_count > 1:
+        workers.supervise(serve, worker_count)
+    else:
+        serve(0)
 
 
+if __name__ == "__main__":
+    main()
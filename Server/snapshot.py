@@ -0,0 +1,161 @@
+"""
+Serialized diagnosis-key snapshot shared between worker processes.
+
+The snapshot is rebuilt shortly after uploads, off the request path, and written to a file, normally on tmpfs. Each
+worker maps the file with ``mmap`` and serves refresh requests straight from the mapping, so no worker has to query the
+database or serialize the keys itself. A new snapshot is written to a temporary file and renamed over the old one, so
+readers always see a complete snapshot and pick up the new one by noticing the file has changed.
+
+The snapshot holds one shard of keys per region and day, serialized as key sets (see ``keyset``), plus a shard of all
+keys under the key ``None`` for clients that do not ask for specific regions. A rebuild only needs to read the shards
+that have new keys from the database and can copy the others from the snapshot it replaces. The header records the
+``diag_id`` of the last key published, so a rebuild also finds keys stored since then that the worker which stored
+them never published, e.g. because it crashed first. The file starts with the header, followed by a pickled index
+mapping each shard's key to its offset, its length and the version of the snapshot it last changed in, followed by the
+shards. Clients that reconnect tell the server the version they last saw and are only sent the shards changed since.
+"""
+import fcntl
+import logging
+import mmap
+import os
+import pickle
+import struct
+import time
+
+import metrics
+
+# Magic bytes, version (nanosecond timestamp), diag_id of the last key published and length of the index
+HEADER = struct.Struct("<4sQQQ")
+MAGIC = b"CKS1"
+
+log = logging.getLogger("coronomo.snapshot")
+
+
+def publish(path, shards, last_id, previous=None):
+    """
+    Atomically replaces the snapshot at ``path``
+
+    :param path: path of the snapshot file
+    :param shards: dictionary mapping each shard's key to its serialized diagnosis keys
+    :param last_id: the highest ``diag_id`` of the keys in the shards
+    :param previous: index of the snapshot being replaced, whose shards of the same length keep the version they last
+        changed in. Diagnosis keys are only ever added, so a shard has changed exactly when its length has.
+    :return: version of the new snapshot and its size in bytes
+    """
+    version = time.time_ns()
+    previous = previous or {}
+    index = {}
+    offset = 0
+    for key, shard in shards.items():
+        old = previous.get(key)
+        index[key] = (offset, len(shard), old[2] if old is not None and old[1] == len(shard) else version)
+        offset += len(shard)
+    index = pickle.dumps(index)
+
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, version, last_id, len(index)))
+        file.write(index)
+        for shard in shards.values():
+            file.write(shard)
+    os.replace(temp_path, path)
+    return version, HEADER.size + len(index) + offset
+
+
+def rebuild(path, build):
+    """
+    Builds and publishes a new snapshot. Rebuilds are serialized across processes with a lock file, so a snapshot
+    built from an older read of the database can never replace a newer one.
+
+    :param path: path of the snapshot file
+    :param build: function given the current ``Snapshot``, or None if there is none yet, and returning the shards to
+        publish and the highest ``diag_id`` among their keys, or None if they could not be read
+    :return: True if a new snapshot was published
+    """
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with metrics.timed("snapshot_rebuild_seconds"):
+                current = None
+                if os.path.exists(path):
+                    current = Snapshot(path)
+                    try:
+                        current.refresh()
+                    except ValueError:
+                        # Written by an older server, so it is built again from scratch
+                        current = None
+                built = build(current)
+                if built is None:
+                    log.error("Could not build the diagnosis key snapshot, keeping the previous one")
+                    return False
+                shards, last_id = built
+                version, size = publish(path, shards, last_id, None if current is None else current.index)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    metrics.set_gauge("snapshot_bytes", size)
+    metrics.set_gauge("snapshot_shards", len(shards))
+    log.info("Published diagnosis key snapshot", extra={"version": version, "shards": len(shards), "bytes": size})
+    return True
+
+
+def changed_shards(index, since):
+    """
+    :param index: index of a snapshot
+    :param since: version of an earlier snapshot
+    :return: list of the keys of shards that are new or have changed since that snapshot, excluding the shard of all
+        keys
+    """
+    return [key for key, (_, _, changed) in index.items() if key is not None and changed > since]
+
+
+class Snapshot:
+    """
+    Read-only view of the snapshot file, remapped whenever a new snapshot is published
+    """
+    def __init__(self, path):
+        self.path = path
+        self.version = None
+        self.last_id = 0
+        self.index = {}
+        self._stamp = None
+        self._mmap = None
+        self._start = 0
+
+    def refresh(self):
+        """
+        Maps the latest snapshot if the file has been replaced since it was last mapped
+
+        :return: True if a different snapshot is now mapped
+        :raise ValueError: if the file is not a snapshot in this format
+        """
+        stat = os.stat(self.path)
+        stamp = (stat.st_ino, stat.st_mtime_ns)
+        if stamp == self._stamp:
+            return False
+
+        with open(self.path, "rb") as file:
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mapping) < HEADER.size or mapping[:len(MAGIC)] != MAGIC:
+            mapping.close()
+            raise ValueError(f"{self.path} is not a diagnosis key snapshot")
+        _, version, last_id, index_length = HEADER.unpack_from(mapping)
+        index = pickle.loads(mapping[HEADER.size:HEADER.size + index_length])
+
+        if self._mmap is not None:
+            self._mmap.close()
+        self._mmap, self.index, self.version, self.last_id, self._stamp = mapping, index, version, last_id, stamp
+        self._start = HEADER.size + index_length
+        return True
+
+    def shard(self, key):
+        """
+        :param key: ``(region, day)``, or None for all keys
+        :return: the serialized diagnosis keys of the shard in the latest snapshot, or None if it has no keys
+        """
+        self.refresh()
+        location = self.index.get(key)
+        if location is None:
+            return None
+        offset, length, _ = location
+        return self._mmap[self._start + offset:self._start + offset + length]
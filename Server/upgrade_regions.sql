@@ -0,0 +1,10 @@
+USE coronomo;
+
+# Upgrades a database created before diagnosis keys had regions, coronomo.sql only sets up new databases. Keys
+# uploaded before then are given the server's default region, see region_info in config.py.
+ALTER TABLE diagnosis_keys
+  ADD COLUMN region VARCHAR(8) NOT NULL DEFAULT 'AU-SA',
+  ADD INDEX(region, en_interval_num);
+
+# Uploads always send a region from now on
+ALTER TABLE diagnosis_keys ALTER COLUMN region DROP DEFAULT;
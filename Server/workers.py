@@ -0,0 +1,123 @@
+"""
+Pre-fork supervisor for running several websocket server workers on one port.
+
+Each worker binds the same port with ``SO_REUSEPORT`` and the kernel spreads incoming connections between them. The
+supervisor restarts workers that die, restarts all workers one at a time on ``SIGHUP`` (e.g. after a deploy) and
+stops them gracefully on ``SIGTERM`` or ``SIGINT``. During a restart each replacement worker is started next to the
+worker it replaces, and the old worker is only asked to stop once the replacement is running. Old workers then finish
+their open connections in the background while the restart moves on.
+"""
+import logging
+import multiprocessing
+import signal
+import time
+
+# How long a worker may take to finish its open connections before it is killed
+SHUTDOWN_GRACE = 30
+# How long a replacement worker is given to start listening before the worker it replaces is stopped
+STARTUP_DELAY = 1
+
+log = logging.getLogger("coronomo.workers")
+
+
+def _worker_main(target, index):
+    # Workers inherit the supervisor's signal handlers, only the supervisor reacts to SIGINT and SIGHUP
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    target(index)
+
+
+def _spawn(target, index):
+    process = multiprocessing.Process(target=_worker_main, args=(target, index), name=f"coronomo-worker-{index}")
+    process.start()
+    log.info("Started worker", extra={"worker": index, "pid": process.pid})
+    return process
+
+
+def _stop(process):
+    process.terminate()
+    process.join(SHUTDOWN_GRACE)
+    if process.is_alive():
+        log.warning("Worker did not stop in time, killing it", extra={"pid": process.pid, "grace": SHUTDOWN_GRACE})
+        process.kill()
+        process.join()
+
+
+def _drain(process, draining):
+    # Ask the worker to finish its open connections, it is reaped by _reap
+    process.terminate()
+    draining[process] = time.monotonic() + SHUTDOWN_GRACE
+
+
+def _reap(draining):
+    for process, deadline in list(draining.items()):
+        if not process.is_alive():
+            process.join()
+            del draining[process]
+        elif time.monotonic() > deadline:
+            log.warning("Worker did not stop in time, killing it", extra={"pid": process.pid, "grace": SHUTDOWN_GRACE})
+            process.kill()
+            process.join()
+            del draining[process]
+
+
+def _respawn_dead(target, processes):
+    for index, process in list(processes.items()):
+        if not process.is_alive():
+            log.warning("Worker exited, restarting it",
+                        extra={"worker": index, "pid": process.pid, "exitcode": process.exitcode})
+            processes[index] = _spawn(target, index)
+
+
+def _restart(target, processes, draining):
+    for index, old in list(processes.items()):
+        new = _spawn(target, index)
+        time.sleep(STARTUP_DELAY)
+        if not new.is_alive():
+            # Keep the old worker rather than leaving its place empty, the next SIGHUP can try again
+            log.error("Replacement worker exited during startup, stopping the restart",
+                      extra={"worker": index, "pid": new.pid, "exitcode": new.exitcode})
+            new.join()
+            return
+        processes[index] = new
+        _drain(old, draining)
+        _reap(draining)
+        _respawn_dead(target, processes)
+
+
+def supervise(target, workers):
+    """
+    Runs ``workers`` copies of ``target`` in child processes until the supervisor is asked to stop
+
+    :param target: function started in each worker, called with the worker's index. It must install its own SIGTERM
+        handler if it wants to shut down gracefully.
+    :param workers: number of worker processes
+    """
+    requests = []
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, lambda signum, frame: requests.append(signum))
+
+    processes = {index: _spawn(target, index) for index in range(workers)}
+    # Replaced workers that are finishing their open connections, and when they must be killed
+    draining = {}
+
+    while True:
+        time.sleep(0.5)
+
+        if signal.SIGTERM in requests or signal.SIGINT in requests:
+            break
+
+        if signal.SIGHUP in requests:
+            requests.clear()
+            log.info("Restarting workers")
+            _restart(target, processes, draining)
+
+        _reap(draining)
+        _respawn_dead(target, processes)
+
+    log.info("Stopping workers")
+    for process in list(processes.values()) + list(draining):
+        process.terminate()
+    for process in list(processes.values()) + list(draining):
+        _stop(process)